@@ -0,0 +1,69 @@
+import io
+import queue
+import re
+import threading
+import time
+
+from collections import deque
+from pathlib import Path
+
+
+class Autosaver:
+    # snapshots are taken in memory on the emulator thread, files are written on a background thread
+    def __init__(self, env, directory, every_actions=500, every_seconds=60.0, keep=10):
+        self.env = env
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.every_actions = every_actions
+        self.every_seconds = every_seconds
+        self.keep = keep
+        self.known_events = set(env.current_event_flags_set)
+        self.last_actions = 0
+        self.last_time = time.monotonic()
+        self.rolling = deque(sorted(self.directory.glob("autosave_*.state")))
+        self.writes = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def after_step(self, num_actions):
+        new_events = [
+            name for key, name in self.env.current_event_flags_set.items()
+            if key not in self.known_events
+        ]
+        if new_events:
+            self.known_events = set(self.env.current_event_flags_set)
+        due = (
+            num_actions - self.last_actions >= self.every_actions
+            or time.monotonic() - self.last_time >= self.every_seconds
+        )
+        if not (due or new_events):
+            return
+        state = io.BytesIO()
+        self.env.pyboy.save_state(state)
+        if due:
+            self.last_actions = num_actions
+            self.last_time = time.monotonic()
+            self.writes.put((f"autosave_{num_actions:07d}.state", state, True))
+        if new_events:
+            name = re.sub(r"[^A-Za-z0-9]+", "_", new_events[0]).strip("_")
+            self.writes.put((f"event_{num_actions:07d}_{name}.state", state, False))
+
+    def run(self):
+        while True:
+            item = self.writes.get()
+            if item is None:
+                return
+            file_name, state, rolling = item
+            path = self.directory / file_name
+            # write to a temporary file first so that a crash never leaves a broken savestate
+            tmp_path = path.with_suffix(".tmp")
+            tmp_path.write_bytes(state.getbuffer())
+            tmp_path.replace(path)
+            if rolling:
+                self.rolling.append(path)
+                while len(self.rolling) > self.keep:
+                    self.rolling.popleft().unlink(missing_ok=True)
+
+    def close(self):
+        self.writes.put(None)
+        self.thread.join()
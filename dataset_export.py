@@ -0,0 +1,129 @@
+import argparse
+import hashlib
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from red_gym_env_v2 import RedGymEnv
+from replay_common import load_actions, make_config
+from screen_packing import pack_screens, unpack_screens
+
+# Exported replays store every distinct screen once in a frame table of packed frames.
+# frame_ids[i] is the screen after actions[i], which earned rewards[i]. The screen right after
+# reset is not stored, PyBoy does not draw it when a savestate is loaded.
+
+
+def frame_hash(packed_frame):
+    return hashlib.blake2b(packed_frame.tobytes(), digest_size=8).digest()
+
+
+class FrameTable:
+    def __init__(self):
+        self.frames = []
+        self.ids_by_hash = {}
+
+    def add(self, packed_frame):
+        # returns the id of the frame, equal screens share one id
+        key = frame_hash(packed_frame)
+        frame_id = self.ids_by_hash.get(key)
+        if frame_id is not None and np.array_equal(self.frames[frame_id], packed_frame):
+            return frame_id
+        frame_id = len(self.frames)
+        self.frames.append(packed_frame.copy())
+        if key not in self.ids_by_hash:
+            self.ids_by_hash[key] = frame_id
+        return frame_id
+
+    def __len__(self):
+        return len(self.frames)
+
+    def to_array(self):
+        if not self.frames:
+            return np.zeros((0, 144, 40), dtype=np.uint8)
+        return np.stack(self.frames)
+
+
+def export_replay(replay_path, rom, state, out_path):
+    env = RedGymEnv(config=make_config(rom, state, headless=True))
+    env.reset()
+    actions = np.array(load_actions(replay_path), dtype=np.uint8)
+    rewards = np.zeros(len(actions), dtype=np.float32)
+    frame_ids = np.zeros(len(actions), dtype=np.int32)
+    table = FrameTable()
+    for step, action in enumerate(actions):
+        _, rewards[step], _, _, _ = env.step(action)
+        frame_ids[step] = table.add(pack_screens(env.render(reduce_res=False)))
+    env.close()
+
+    np.savez_compressed(
+        out_path, frames=table.to_array(), frame_ids=frame_ids, actions=actions, rewards=rewards
+    )
+    return len(frame_ids), len(table)
+
+
+class ExportedReplay:
+    # frame ids are resolved on access, packed frames are views into the frame table
+    def __init__(self, path):
+        with np.load(path) as data:
+            self.frames = data["frames"]
+            self.frame_ids = data["frame_ids"]
+            self.actions = data["actions"]
+            self.rewards = data["rewards"]
+
+    def __len__(self):
+        # number of transitions between consecutive screens
+        return max(len(self.actions) - 1, 0)
+
+    @property
+    def dedup_ratio(self):
+        return len(self.frame_ids) / max(len(self.frames), 1)
+
+    def packed_frame(self, step):
+        return self.frames[self.frame_ids[step]]
+
+    def screen(self, step):
+        return unpack_screens(self.packed_frame(step))
+
+    def transition(self, step):
+        # (screen, action, reward, next screen)
+        return self.screen(step), self.actions[step + 1], self.rewards[step + 1], self.screen(step + 1)
+
+    def screens(self, steps):
+        # unpacks each distinct frame of the batch once
+        unique_ids, inverse = np.unique(self.frame_ids[steps], return_inverse=True)
+        return unpack_screens(self.frames[unique_ids])[inverse]
+
+
+def export_job(job):
+    replay_path, rom, state, out_dir = job
+    out_path = Path(out_dir) / f"{Path(replay_path).stem}.npz"
+    num_frames, num_unique = export_replay(replay_path, rom, state, out_path)
+    return replay_path, num_frames, num_unique
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export replays as deduplicated frame datasets')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--out', type=str, help='Output directory for the datasets', default="./session/dataset")
+    parser.add_argument('--workers', type=int, help='Number of parallel workers', default=None)
+    args = parser.parse_args()
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    replay_paths = sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem))
+    jobs = [(str(p), args.rom, args.state, str(out_dir)) for p in replay_paths]
+    total_frames = total_unique = 0
+    with Pool(args.workers) as pool:
+        for replay_path, num_frames, num_unique in pool.imap_unordered(export_job, jobs):
+            total_frames += num_frames
+            total_unique += num_unique
+            print(f"{Path(replay_path).stem}: {num_frames} frames, {num_unique} unique, dedup ratio {num_frames / max(num_unique, 1):.2f}")
+    if total_unique:
+        print(f"Corpus: {total_frames} frames, {total_unique} unique, dedup ratio {total_frames / total_unique:.2f}")
+
+
+if __name__ == "__main__":
+    main()
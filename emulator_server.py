@@ -0,0 +1,284 @@
+import argparse
+import json
+import queue
+import socket
+import socketserver
+import struct
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from red_gym_env_v2 import RedGymEnv
+from replay_common import load_actions, make_config
+from screen_packing import pack_screens
+
+WRAM_START = 0xC000
+WRAM_END = 0xE000
+
+# Wire format: every message is a 4 byte big-endian header length, a JSON header and
+# the raw bytes of the arrays listed in header["arrays"] (name, dtype, shape) in order.
+
+
+def send_message(sock, header, arrays=None):
+    arrays = arrays or {}
+    header = dict(header)
+    header["arrays"] = [
+        {"name": name, "dtype": str(arr.dtype), "shape": list(arr.shape)}
+        for name, arr in arrays.items()
+    ]
+    payload = json.dumps(header).encode()
+    chunks = [struct.pack(">I", len(payload)), payload]
+    chunks += [np.ascontiguousarray(arr).tobytes() for arr in arrays.values()]
+    sock.sendall(b"".join(chunks))
+
+
+def recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while n:
+        received = sock.recv_into(view, n)
+        if received == 0:
+            raise ConnectionError("connection closed")
+        view = view[received:]
+        n -= received
+    return buf
+
+
+def recv_message(sock):
+    (length,) = struct.unpack(">I", recv_exact(sock, 4))
+    header = json.loads(recv_exact(sock, length))
+    arrays = {}
+    for spec in header.pop("arrays", []):
+        dtype = np.dtype(spec["dtype"])
+        nbytes = int(np.prod(spec["shape"], dtype=np.int64)) * dtype.itemsize
+        arrays[spec["name"]] = np.frombuffer(
+            recv_exact(sock, nbytes), dtype=dtype
+        ).reshape(spec["shape"])
+    return header, arrays
+
+
+class EnvWorker:
+    # owns one RedGymEnv, all jobs for it run on this thread. A job returns its replies
+    # instead of sending them: the worker emulates every job that queued up while the
+    # previous batch was running back to back and only then hands the replies to the
+    # client threads, so socket writes never stall the emulator.
+    def __init__(self, env_id, config):
+        self.env_id = env_id
+        self.env = RedGymEnv(config=config)
+        self.env.reset()
+        self.jobs = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, fn):
+        done = threading.Event()
+        job = {"fn": fn, "done": done, "error": None, "replies": []}
+        self.jobs.put(job)
+        return job
+
+    def run(self):
+        while True:
+            batch = [self.jobs.get()]
+            while True:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+            for job in batch:
+                try:
+                    job["replies"] = job["fn"](self.env) or []
+                except Exception as e:
+                    job["error"] = e
+            for job in batch:
+                job["done"].set()
+
+
+def collect_outputs(env, obs, outputs):
+    arrays = {}
+    if "obs" in outputs:
+        for key, value in obs.items():
+            arrays[f"obs/{key}"] = np.asarray(value)
+    if "ram" in outputs:
+        arrays["ram"] = np.array(env.pyboy.memory[WRAM_START:WRAM_END], dtype=np.uint8)
+    if "frame" in outputs:
+        arrays["frame"] = np.array(env.render(reduce_res=False)[:, :, 0])
+    if "packed_frame" in outputs:
+        # 4x smaller on the wire, restore with screen_packing.unpack_screens
+        arrays["packed_frame"] = pack_screens(env.render(reduce_res=False))
+    return arrays
+
+
+class ReusableTCPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+
+
+class EmulatorServer:
+    # session envs are driven by clients with reset/step, replays run on their own envs
+    # so they never reset an env in the middle of somebody else's session
+    def __init__(self, config, num_envs, num_replay_envs=1):
+        # long lived envs that are rarely reset, only keep the latest agent_stats rows
+        config = dict(config, agent_stats_policy="drop")
+        self.workers = [EnvWorker(i, config) for i in range(num_envs)]
+        self.replay_workers = [EnvWorker(i, config) for i in range(num_replay_envs)]
+
+    def pick_worker(self, workers, env_id=None):
+        if env_id is not None:
+            return workers[env_id]
+        return min(workers, key=lambda w: w.jobs.qsize())
+
+    def run_on_worker(self, sock, worker, fn):
+        job = worker.submit(fn)
+        job["done"].wait()
+        if job["error"] is not None:
+            raise job["error"]
+        for header, arrays in job["replies"]:
+            send_message(sock, header, arrays)
+
+    def handle_request(self, sock, request):
+        cmd = request["cmd"]
+        outputs = request.get("outputs", ["obs"])
+        if cmd == "envs":
+            send_message(sock, {"status": "ok", "envs": len(self.workers), "replay_envs": len(self.replay_workers)})
+        elif cmd == "reset":
+            worker = self.pick_worker(self.workers, request["env"])
+
+            def reset(env):
+                obs, _ = env.reset()
+                return [({"status": "ok", "env": worker.env_id, "step": 0}, collect_outputs(env, obs, outputs))]
+
+            self.run_on_worker(sock, worker, reset)
+        elif cmd == "step":
+            worker = self.pick_worker(self.workers, request["env"])
+
+            def step(env):
+                replies = []
+                for action in request["actions"]:
+                    obs, reward, _, _, _ = env.step(action)
+                    replies.append((
+                        {"status": "step", "env": worker.env_id, "step": env.step_count, "reward": reward},
+                        collect_outputs(env, obs, outputs),
+                    ))
+                replies.append(({"status": "ok", "env": worker.env_id}, None))
+                return replies
+
+            self.run_on_worker(sock, worker, step)
+        elif cmd == "replay":
+            # env indexes the replay envs, replays stream their steps as they are emulated
+            worker = self.pick_worker(self.replay_workers, request.get("env"))
+            actions = load_actions(request["file"])
+            start = request.get("start", 0)
+            end = min(request.get("end", len(actions)), len(actions))
+
+            def replay(env):
+                env.reset()
+                for action in actions[:start]:
+                    env.step(action)
+                for i in range(start, end):
+                    obs, reward, _, _, _ = env.step(actions[i])
+                    send_message(
+                        sock,
+                        {"status": "step", "env": worker.env_id, "step": i, "reward": reward},
+                        collect_outputs(env, obs, outputs),
+                    )
+                send_message(sock, {"status": "ok", "env": worker.env_id})
+
+            self.run_on_worker(sock, worker, replay)
+        else:
+            raise ValueError(f"unknown command: {cmd}")
+
+    def make_handler(self):
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                while True:
+                    try:
+                        request, _ = recv_message(self.request)
+                    except ConnectionError:
+                        return
+                    # a message may carry a single request or a batch of them
+                    for sub_request in request.get("batch", [request]):
+                        try:
+                            server.handle_request(self.request, sub_request)
+                        except (ConnectionError, BrokenPipeError):
+                            return
+                        except Exception as e:
+                            send_message(self.request, {"status": "error", "error": repr(e)})
+
+        return Handler
+
+    def serve(self, address):
+        if isinstance(address, str):
+            Path(address).unlink(missing_ok=True)
+            server_cls = socketserver.ThreadingUnixStreamServer
+        else:
+            server_cls = ReusableTCPServer
+        with server_cls(address, self.make_handler()) as server:
+            server.daemon_threads = True
+            print(f"Serving {len(self.workers)} environments and {len(self.replay_workers)} replay environments on {address}")
+            server.serve_forever()
+
+
+class EmulatorClient:
+    def __init__(self, address=("127.0.0.1", 7450)):
+        family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.connect(address)
+
+    def close(self):
+        self.sock.close()
+
+    def request(self, request):
+        # yields (header, arrays) for every streamed step, returns on the final status message
+        send_message(self.sock, request)
+        while True:
+            header, arrays = recv_message(self.sock)
+            if header["status"] == "error":
+                raise RuntimeError(header["error"])
+            if header["status"] != "step":
+                return
+            yield header, arrays
+
+    def reset(self, env, outputs=("obs",)):
+        send_message(self.sock, {"cmd": "reset", "env": env, "outputs": list(outputs)})
+        header, arrays = recv_message(self.sock)
+        if header["status"] == "error":
+            raise RuntimeError(header["error"])
+        return arrays
+
+    def step(self, env, actions, outputs=("obs",)):
+        if isinstance(actions, int):
+            actions = [actions]
+        return list(self.request(
+            {"cmd": "step", "env": env, "actions": list(actions), "outputs": list(outputs)}
+        ))
+
+    def replay(self, file, start=0, end=None, outputs=("frame",), env=None):
+        request = {"cmd": "replay", "file": str(file), "start": start, "outputs": list(outputs), "env": env}
+        if end is not None:
+            request["end"] = end
+        yield from self.request(request)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a pool of warm Pokemon Red environments to local clients')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--envs', type=int, help='Number of environments for reset/step sessions', default=4)
+    parser.add_argument('--replay-envs', type=int, help='Number of environments reserved for replay requests', default=1)
+    parser.add_argument('--port', type=int, help='TCP port on localhost', default=7450)
+    parser.add_argument('--socket', type=str, help='Serve on this Unix socket instead of TCP', default=None)
+    args = parser.parse_args()
+
+    config = make_config(args.rom, args.state, headless=True)
+    server = EmulatorServer(config, args.envs, args.replay_envs)
+    address = args.socket if args.socket is not None else ("127.0.0.1", args.port)
+    try:
+        server.serve(address)
+    except KeyboardInterrupt:
+        print("Process interrupted, exiting...")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+from collections import deque
+from dataclasses import dataclass
+
+import numpy as np
+
+event_flags_start = 0xD747
+event_flags_end = 0xD887
+NUM_EVENT_BITS = (event_flags_end - event_flags_start) * 8
+# steps between full scans of the event bytes, an interval of 1 scans every step like polling
+DEFAULT_SCAN_INTERVAL = 100
+
+# FlagAction actions, passed in register b
+FLAG_RESET = 0
+FLAG_SET = 1
+FLAG_READ = 2
+
+
+@dataclass
+class EventFlagChange:
+    step: int  # index of the action during which the flag changed
+    frame: int
+    bit: int  # (address - event_flags_start) * 8 + bit, see events.event_bit_table
+    value: int
+    source: str  # "hook" or "scan"
+
+
+class EventFlagMonitor:
+    # pushes event flag changes into a queue
+    # pokered changes flags either through FlagAction (action b on bit c of the bit array at hl),
+    # which is hooked so those changes are exact to the frame, or through the inline SetEvent /
+    # ResetEvent macros, which have no routine to hook. The latter are picked up by scanning the
+    # event bytes every scan_interval steps, which doubles as consistency check for the hook.
+    def __init__(self, env, scan_interval=DEFAULT_SCAN_INTERVAL):
+        self.env = env
+        self.scan_interval = scan_interval
+        self.notifications = deque()
+        self.flags = np.zeros(NUM_EVENT_BITS, dtype=np.uint8)
+        self.env.pyboy.hook_register(None, "FlagAction", self.flag_action_hook, None)
+
+    def reset(self):
+        self.notifications.clear()
+        self.flags = self.read_flags()
+
+    def read_flags(self):
+        return np.unpackbits(self.env.read_event_bytes(), bitorder="little")
+
+    def flag_action_hook(self, *args, **kwargs):
+        registers = self.env.pyboy.register_file
+        if registers.B == FLAG_READ:
+            return
+        bit = (registers.HL - event_flags_start) * 8 + registers.C
+        if not 0 <= bit < NUM_EVENT_BITS:
+            return
+        value = int(registers.B == FLAG_SET)
+        if self.flags[bit] != value:
+            self.flags[bit] = value
+            self.notifications.append(EventFlagChange(
+                self.env.step_count, self.env.pyboy.frame_count, bit, value, "hook"
+            ))
+
+    def scan(self):
+        flags = self.read_flags()
+        for bit in np.flatnonzero(flags != self.flags):
+            self.notifications.append(EventFlagChange(
+                self.env.step_count, self.env.pyboy.frame_count, int(bit), int(flags[bit]), "scan"
+            ))
+        self.flags = flags
+
+    def after_step(self):
+        if (self.env.step_count + 1) % self.scan_interval == 0:
+            self.scan()
+
+    def drain(self):
+        changes = []
+        while self.notifications:
+            changes.append(self.notifications.popleft())
+        return changes
@@ -2613,3 +2613,16 @@ def filter_event_names(events):
 
 # Get the filtered list of event names
 filtered_event_names = filter_event_names(events)
+
+
+def create_event_bit_table(events, flags_start=0xD747):
+    # map each event bit index to its (key, name), bit index = (address - flags_start) * 8 + bit
+    # bits are LSB-first within each byte, matching both the keys and np.unpackbits(bitorder="little")
+    table = [None] * len(events)
+    for key, value in events.items():
+        address, bit = key.split("-")
+        table[(int(address, 16) - flags_start) * 8 + int(bit)] = (key, value)
+    return table
+
+# Precomputed bit index -> (key, name) lookup
+event_bit_table = create_event_bit_table(events)
@@ -0,0 +1,140 @@
+import argparse
+import os
+import pickle
+import select
+import time
+import traceback
+from pathlib import Path
+
+from red_gym_env_v2 import RedGymEnv
+from replay import replay_actions
+from replay_common import load_actions, make_config
+from stats_wrapper import StatsWrapper
+
+# Batch replays from one warm parent: modules, PyBoy, the ROM, pokered.sym and the start
+# states are loaded once and every worker is an os.fork of the parent. Workers share those
+# pages copy-on-write and only restore their start state with env.reset().
+
+
+def memory_usage():
+    # (rss, pss) of this process in kB, pss splits shared pages between the processes using them
+    usage = {}
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("Rss", "Pss"):
+                usage[key] = int(value.split()[0])
+    return usage["Rss"], usage["Pss"]
+
+
+def replay_stats(env, replay_path):
+    replay_actions(env, load_actions(replay_path))
+    return env.get_info()
+
+
+class ForkedReplayer:
+    def __init__(self, config, lightweight=False):
+        start = time.perf_counter()
+        if lightweight:
+            from replay_env import ReplayEnv
+            self.env = StatsWrapper(ReplayEnv(config))
+        else:
+            self.env = StatsWrapper(RedGymEnv(config))
+        self.env.reset()
+        self.warmup_seconds = time.perf_counter() - start
+
+    def run_child(self, write_fd, replay_path, fn, fork_time):
+        try:
+            self.env.reset()
+            startup = time.perf_counter() - fork_time
+            start = time.perf_counter()
+            result = fn(self.env, replay_path)
+            rss, pss = memory_usage()
+            payload = ("ok", result, {
+                "startup": startup, "seconds": time.perf_counter() - start, "rss": rss, "pss": pss
+            })
+        except Exception:
+            payload = ("error", traceback.format_exc(), None)
+        data = pickle.dumps(payload)
+        with os.fdopen(write_fd, "wb") as f:
+            f.write(data)
+
+    def fork(self, replay_path, fn):
+        read_fd, write_fd = os.pipe()
+        fork_time = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            exit_code = 0
+            try:
+                self.run_child(write_fd, replay_path, fn, fork_time)
+            except BaseException:
+                exit_code = 1
+            # skip the parent's atexit handlers and PyBoy shutdown
+            os._exit(exit_code)
+        os.close(write_fd)
+        return pid, read_fd
+
+    def run(self, replay_paths, workers=None, fn=replay_stats):
+        # yields (replay path, fn result, worker stats) in completion order
+        workers = workers or os.cpu_count()
+        pending = list(replay_paths)[::-1]
+        running = {}  # read fd -> (pid, replay path, received chunks)
+        while pending or running:
+            while pending and len(running) < workers:
+                replay_path = pending.pop()
+                pid, read_fd = self.fork(replay_path, fn)
+                running[read_fd] = (pid, replay_path, [])
+            ready, _, _ = select.select(list(running), [], [])
+            for read_fd in ready:
+                chunk = os.read(read_fd, 1 << 16)
+                if chunk:
+                    running[read_fd][2].append(chunk)
+                    continue
+                os.close(read_fd)
+                pid, replay_path, chunks = running.pop(read_fd)
+                os.waitpid(pid, 0)
+                if not chunks:
+                    raise RuntimeError(f"Worker for {replay_path} exited without a result")
+                status, result, stats = pickle.loads(b"".join(chunks))
+                if status == "error":
+                    raise RuntimeError(f"Worker for {replay_path} failed:\n{result}")
+                yield replay_path, result, stats
+
+    def close(self):
+        self.env.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a corpus with workers forked from one warm emulator')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--workers', type=int, help='Number of concurrent workers', default=None)
+    parser.add_argument('--lightweight', action='store_true', help="Use the minimal ReplayEnv.", default=False)
+    args = parser.parse_args()
+
+    replay_paths = sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem))
+    replayer = ForkedReplayer(make_config(args.rom, args.state, headless=True), args.lightweight)
+    print(f"Warm parent ready in {replayer.warmup_seconds:.2f}s")
+    startups, total_rss, total_pss = [], 0, 0
+    for replay_path, info, stats in replayer.run([str(p) for p in replay_paths], args.workers):
+        startups.append(stats["startup"])
+        total_rss += stats["rss"]
+        total_pss += stats["pss"]
+        print(
+            f"{Path(replay_path).stem}: events_sum {info['events_sum']}, seen_coords {info['seen_coords']},"
+            f" startup {stats['startup'] * 1000:.1f}ms, replay {stats['seconds']:.1f}s,"
+            f" rss {stats['rss'] / 1024:.0f}MB, pss {stats['pss'] / 1024:.0f}MB"
+        )
+    replayer.close()
+    if startups:
+        print(
+            f"Worker startup: mean {sum(startups) / len(startups) * 1000:.1f}ms, max {max(startups) * 1000:.1f}ms"
+            f" (cold env construction {replayer.warmup_seconds * 1000:.0f}ms)"
+        )
+        print(f"Workers at exit: rss sum {total_rss / 1024:.0f}MB, pss sum {total_pss / 1024:.0f}MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 # adapted from https://github.com/thatguy11325/pokemonred_puffer/blob/main/pokemonred_puffer/global_map.py
 
+import numpy as np
+
 from map_data import map_data
 
 PAD = 20
@@ -25,4 +27,31 @@ def local_to_global(r: int, c: int, map_n: int):
         return GLOBAL_MAP_SHAPE[0] // 2, GLOBAL_MAP_SHAPE[1] // 2
     except KeyError:
         print(f"Map id {map_n} not found in map_data.py.")
-        return GLOBAL_MAP_SHAPE[0] // 2, GLOBAL_MAP_SHAPE[1] // 2
\ No newline at end of file
+        return GLOBAL_MAP_SHAPE[0] // 2, GLOBAL_MAP_SHAPE[1] // 2
+
+# Vectorized local_to_global over whole trajectories, lookup tables indexed by map id
+_MAX_MAP_ID = 256
+_MAP_ROW_BASE = np.zeros(_MAX_MAP_ID, dtype=np.int64)
+_MAP_COL_BASE = np.zeros(_MAX_MAP_ID, dtype=np.int64)
+_MAP_KNOWN = np.zeros(_MAX_MAP_ID, dtype=bool)
+for _map_n, _region in MAP_DATA.items():
+    if 0 <= _map_n < _MAX_MAP_ID:
+        _MAP_COL_BASE[_map_n], _MAP_ROW_BASE[_map_n] = _region["coordinates"]
+        _MAP_KNOWN[_map_n] = True
+
+
+def local_to_global_batch(r, c, map_n):
+    # same semantics as local_to_global: unknown maps and out of bounds coords go to the center
+    r = np.asarray(r, dtype=np.int64)
+    c = np.asarray(c, dtype=np.int64)
+    map_n = np.asarray(map_n, dtype=np.int64)
+    gy = r + _MAP_ROW_BASE[map_n] + MAP_ROW_OFFSET
+    gx = c + _MAP_COL_BASE[map_n] + MAP_COL_OFFSET
+    valid = (
+        _MAP_KNOWN[map_n]
+        & (0 <= gy) & (gy < GLOBAL_MAP_SHAPE[0])
+        & (0 <= gx) & (gx < GLOBAL_MAP_SHAPE[1])
+    )
+    gy = np.where(valid, gy, GLOBAL_MAP_SHAPE[0] // 2)
+    gx = np.where(valid, gx, GLOBAL_MAP_SHAPE[1] // 2)
+    return gy, gx
@@ -0,0 +1,85 @@
+import argparse
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+from global_map import GLOBAL_MAP_SHAPE, MAP_DATA, MAP_ROW_OFFSET, MAP_COL_OFFSET
+from trajectory import load_trajectory
+
+
+def build_heatmap(trajectory):
+    flat = np.ravel_multi_index(
+        (trajectory["global_y"], trajectory["global_x"]), GLOBAL_MAP_SHAPE
+    )
+    counts = np.bincount(flat, minlength=GLOBAL_MAP_SHAPE[0] * GLOBAL_MAP_SHAPE[1])
+    return counts.reshape(GLOBAL_MAP_SHAPE).astype(np.uint32)
+
+
+def map_footprint():
+    # mask of all tiles covered by a known map, used as background for the overlay
+    footprint = np.zeros(GLOBAL_MAP_SHAPE, dtype=bool)
+    for map_n, region in MAP_DATA.items():
+        if map_n < 0:
+            continue
+        col, row = region["coordinates"]
+        width, height = region["tileSize"]
+        footprint[
+            row + MAP_ROW_OFFSET:row + MAP_ROW_OFFSET + height,
+            col + MAP_COL_OFFSET:col + MAP_COL_OFFSET + width,
+        ] = True
+    return footprint
+
+
+def save_heatmap_png(heatmap, path, title=None):
+    fig, ax = plt.subplots(figsize=(8, 8))
+    ax.imshow(map_footprint(), cmap="Greys", vmin=0, vmax=4, interpolation="nearest")
+    visits = np.ma.masked_equal(np.log1p(heatmap), 0)
+    im = ax.imshow(visits, cmap="inferno", alpha=0.9, interpolation="nearest")
+    fig.colorbar(im, ax=ax, fraction=0.046, pad=0.04, label="log(1 + visits)")
+    if title is not None:
+        ax.set_title(title)
+    ax.axis("off")
+    fig.savefig(path, dpi=150, bbox_inches="tight")
+    plt.close(fig)
+
+
+def process_replay(job):
+    replay_path, rom, state = job
+    trajectory = load_trajectory(replay_path, rom, state)
+    return replay_path, build_heatmap(trajectory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build global visitation heatmaps from replays')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--out', type=str, help='Output directory for heatmaps', default="./session/heatmaps")
+    parser.add_argument('--workers', type=int, help='Number of parallel workers', default=None)
+    args = parser.parse_args()
+
+    out_dir = Path(args.out)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    replay_paths = sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem))
+    jobs = [(str(p), args.rom, args.state) for p in replay_paths]
+
+    corpus = np.zeros(GLOBAL_MAP_SHAPE, dtype=np.uint64)
+    with Pool(args.workers) as pool:
+        for replay_path, heatmap in pool.imap_unordered(process_replay, jobs):
+            name = Path(replay_path).stem
+            np.save(out_dir / f"{name}.npy", heatmap)
+            save_heatmap_png(heatmap, out_dir / f"{name}.png", title=name)
+            corpus += heatmap
+            print(f"{name}: {int(heatmap.sum())} steps, {int((heatmap > 0).sum())} tiles visited")
+
+    np.save(out_dir / "corpus.npy", corpus)
+    save_heatmap_png(corpus, out_dir / "corpus.png", title="corpus")
+    print(f"Corpus: {int((corpus > 0).sum())} tiles visited, saved to {out_dir}")
+
+
+if __name__ == "__main__":
+    main()
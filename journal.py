@@ -0,0 +1,95 @@
+import argparse
+import json
+import os
+import threading
+import time
+
+from collections import deque
+from pathlib import Path
+
+# Append-only action journal. Actions are written in chunks, one line of comma separated
+# actions per chunk. A line only counts once its trailing newline is on disk, so a crash
+# can at most lose the last partially written chunk.
+
+
+def journal_path_for(replay_path):
+    return Path(str(replay_path).replace(".pkl", ".json")).with_suffix(".journal")
+
+
+def recover_journal(path):
+    # returns all complete chunks and cuts off a truncated tail so appending can continue
+    path = Path(path)
+    if not path.exists():
+        return []
+    data = path.read_bytes()
+    complete = data[:data.rfind(b"\n") + 1]
+    if len(complete) != len(data):
+        print(f"Dropping {len(data) - len(complete)} bytes of a truncated chunk from {path}")
+        with open(path, "r+b") as f:
+            f.truncate(len(complete))
+    actions = []
+    for line in complete.decode().splitlines():
+        if line:
+            actions += [int(action) for action in line.split(",")]
+    return actions
+
+
+def export_journal(path, json_path):
+    actions = recover_journal(path)
+    with open(json_path, "w") as f:
+        json.dump(actions, f)
+    return actions
+
+
+class ActionJournal:
+    def __init__(self, path, flush_interval=0.5, fsync_interval=5.0):
+        self.path = Path(path)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.pending = deque()
+        self.file = open(self.path, "ab")
+        self.last_fsync = time.monotonic()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, action):
+        # only touches memory, the writer thread does all disk work
+        self.pending.append(action)
+
+    def write_pending(self, force_fsync=False):
+        chunk = []
+        while self.pending:
+            chunk.append(self.pending.popleft())
+        if chunk:
+            self.file.write((",".join(str(action) for action in chunk) + "\n").encode())
+            self.file.flush()
+        now = time.monotonic()
+        if force_fsync or now - self.last_fsync >= self.fsync_interval:
+            os.fsync(self.file.fileno())
+            self.last_fsync = now
+
+    def run(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.write_pending()
+
+    def close(self):
+        self.stopping.set()
+        self.thread.join()
+        self.write_pending(force_fsync=True)
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export an action journal to a replay JSON file')
+    parser.add_argument('journal', type=str, help='Path to the journal file')
+    parser.add_argument('--out', type=str, help='Path of the replay JSON file', default=None)
+    args = parser.parse_args()
+
+    out = args.out if args.out is not None else str(Path(args.journal).with_suffix(".json"))
+    actions = export_journal(args.journal, out)
+    print(f"Exported {len(actions)} actions to {out}")
+
+
+if __name__ == "__main__":
+    main()
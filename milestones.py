@@ -0,0 +1,97 @@
+import argparse
+import json
+import re
+from multiprocessing import Pool
+from pathlib import Path
+
+from events import filtered_event_names
+from map_data import map_locations
+from red_gym_env_v2 import RedGymEnv
+from replay_common import load_actions, make_config
+from stats_wrapper import StatsWrapper
+
+
+def milestone_slug(name):
+    return re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_").lower()
+
+
+def export_milestones(job):
+    # replays one file and dumps a savestate at the first occurrence of every milestone
+    replay_path, rom, state, event_names, map_ids, out_dir = job
+    env = StatsWrapper(RedGymEnv(config=make_config(rom, state, headless=True)))
+    obs, _ = env.reset()
+    # events_steps also records flags being cleared, an event is only reached when its
+    # bit in the event observation goes from 0 to 1
+    event_bits = {name: filtered_event_names.index(name) for name in event_names}
+    events = obs["events"]
+    pending_events = set(event_names)
+    pending_maps = set(map_ids)
+    exported = []
+    for step, action in enumerate(load_actions(replay_path), start=1):
+        if not (pending_events or pending_maps):
+            break
+        obs, _, _, _, _ = env.step(action)
+        previous_events, events = events, obs["events"]
+        reached_events = {
+            name for name in pending_events
+            if previous_events[event_bits[name]] == 0 and events[event_bits[name]] == 1
+        }
+        reached_maps = {map_id for map_id in pending_maps if env.location_first_visit_steps[map_id] != -1}
+        if not (reached_events or reached_maps):
+            continue
+        pending_events -= reached_events
+        pending_maps -= reached_maps
+        reached = [(f"event_{milestone_slug(name)}", name) for name in sorted(reached_events)]
+        reached += [
+            (f"map_{map_id}_{milestone_slug(map_locations[map_id])}", map_locations[map_id])
+            for map_id in sorted(reached_maps)
+        ]
+        metadata = {
+            "replay": str(replay_path),
+            "step": step,
+            "events_sum": int(env.events_sum),
+            "party_size": int(env.env.read_m(0xD163)),
+            "party_levels": [int(level) for level in env.party_levels],
+            "map": int(env.current_location),
+            "seconds_played": int(env.seconds_played),
+        }
+        for slug, name in reached:
+            milestone_dir = Path(out_dir) / slug
+            milestone_dir.mkdir(parents=True, exist_ok=True)
+            base = milestone_dir / Path(replay_path).stem
+            env.env.save_state(base.with_suffix(".state"))
+            with open(base.with_suffix(".json"), "w") as f:
+                json.dump({"milestone": name, **metadata}, f, indent=2)
+            exported.append((name, step))
+    env.close()
+    return replay_path, exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export savestates at the first occurrence of milestones in replays')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--events', type=str, nargs="*", help='Event names to export', default=["Beat Brock", "Beat Misty"])
+    parser.add_argument('--maps', type=int, nargs="*", help='Map ids to export', default=[59, 3])
+    parser.add_argument('--out', type=str, help='Output directory for the savestates', default="./session/milestones")
+    parser.add_argument('--workers', type=int, help='Number of parallel workers', default=None)
+    args = parser.parse_args()
+
+    for name in args.events:
+        if name not in filtered_event_names:
+            raise ValueError(f"Unknown event name: {name}")
+    for map_id in args.maps:
+        if map_id not in map_locations:
+            raise ValueError(f"Unknown map id: {map_id}")
+
+    replay_paths = sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem))
+    jobs = [(str(p), args.rom, args.state, args.events, args.maps, args.out) for p in replay_paths]
+    with Pool(args.workers) as pool:
+        for replay_path, exported in pool.imap_unordered(export_milestones, jobs):
+            reached = ", ".join(f"{name} @ {step}" for name, step in exported)
+            print(f"{Path(replay_path).stem}: {reached if reached else 'no milestones reached'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,23 +2,33 @@ import argparse
 import numpy as np
 import json
 import pygame
+import threading
 import time
 
+from collections import deque
+
 from pathlib import Path
+from autosave import Autosaver
+from journal import ActionJournal, journal_path_for, recover_journal
 from red_gym_env_v2 import RedGymEnv
 
 
-def process_frame(frame):
-    frame = frame.transpose((1, 0, 2))
-    frame = frame.squeeze()
-    frame = np.stack((frame, frame, frame), axis=-1)
-    return frame
+class FramePresenter:
+    # persistent surfaces, frames are written in place and scaled into a cached target
+    def __init__(self, screen, frame_shape=(144, 160)):
+        self.screen = screen
+        self.surface = pygame.Surface((frame_shape[1], frame_shape[0]), depth=8)
+        # identity grayscale palette, pixel values are shown as they are
+        self.surface.set_palette([(i, i, i) for i in range(256)])
+        self.target = pygame.Surface(screen.get_size(), depth=8)
+        self.target.set_palette([(i, i, i) for i in range(256)])
 
-def update_screen(screen, frame, screen_width, screen_height):
-    obs_surface = pygame.surfarray.make_surface(frame)
-    obs_surface = pygame.transform.scale(obs_surface, (screen_width, screen_height))
-    screen.blit(obs_surface, (0, 0))
-    pygame.display.flip()
+    def present(self, frame):
+        # frame is (height, width), surfarray expects (width, height)
+        pygame.surfarray.blit_array(self.surface, frame.T)
+        pygame.transform.scale(self.surface, self.target.get_size(), self.target)
+        self.screen.blit(self.target, (0, 0))
+        pygame.display.flip()
 
 def execute_preloaded_actions(env, preloaded_actions):
     print("Executing preloaded actions to resume the playthrough...")
@@ -30,14 +40,94 @@ def execute_preloaded_actions(env, preloaded_actions):
             print(f"Progress: {i + 1}/{len(preloaded_actions)}")
 
 
+class EmulatorThread(threading.Thread):
+    # steps the env off the main thread so slow steps never block input capture or display
+    def __init__(self, env, actions, journal, autosaver):
+        super().__init__(daemon=True)
+        self.env = env
+        self.actions = actions
+        self.journal = journal
+        self.autosaver = autosaver
+        # deque append/popleft are atomic, the wakeup event only avoids busy waiting
+        self.inputs = deque()
+        self.wakeup = threading.Event()
+        self.stopping = False
+        self.done = False
+        # exception that stopped the thread, re-raised on the main thread after join
+        self.error = None
+        # double buffered grayscale frames, frame_index points to the latest one
+        self.frames = np.zeros((2, 144, 160), dtype=np.uint8)
+        self.frame_index = 0
+        self.frame_id = 0
+        self.update_frame()
+
+    @property
+    def frame(self):
+        return self.frames[self.frame_index]
+
+    def update_frame(self):
+        screen = self.env.render(reduce_res=False)[:, :, 0]
+        # only publish frames that actually changed
+        if np.array_equal(screen, self.frames[self.frame_index]):
+            return
+        back = 1 - self.frame_index
+        np.copyto(self.frames[back], screen)
+        self.frame_index = back
+        self.frame_id += 1
+
+    def push(self, action):
+        self.inputs.append(action)
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            self.step_inputs()
+        except BaseException as e:
+            self.error = e
+            self.done = True
+
+    def step_inputs(self):
+        while not self.done:
+            if not self.inputs:
+                if self.stopping:
+                    break
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            action = self.inputs.popleft()
+            obs, reward, _, self.done, info = self.env.step(action)
+            self.actions.append(action)
+            self.journal.append(action)
+            self.autosaver.after_step(len(self.actions))
+            self.update_frame()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Play Pokemon Red via Gym environment')
     parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
     parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
     parser.add_argument('--name', type=str, help='Name of the playthrough', default="playthrough.pkl")
     parser.add_argument('--resume', type=str, help='Path to the JSON file with preloaded actions to resume from', default=None)
+    parser.add_argument('--autosave-every', type=int, help='Number of actions between autosave savestates', default=500)
+    parser.add_argument('--autosave-seconds', type=float, help='Seconds between autosave savestates', default=60.0)
+    parser.add_argument('--autosave-keep', type=int, help='Number of rolling autosave savestates to keep', default=10)
+    parser.add_argument('--fsync-interval', type=float, help='Seconds between forced writes of the action journal to disk', default=5.0)
     args = parser.parse_args()
 
+    # A leftover journal belongs to a crashed session, refuse to guess whether it or
+    # --resume holds the action history to continue from
+    journal_path = journal_path_for(args.name)
+    recovered_actions = recover_journal(journal_path)
+    if recovered_actions and args.resume:
+        parser.error(
+            f"{journal_path} holds {len(recovered_actions)} actions of a crashed session and --resume was given."
+            f" Export it with `python journal.py {journal_path}` or remove it, then resume."
+        )
+
     config = {
         "session_path": Path("./session/"),
         "save_final_state": False,
@@ -77,14 +167,21 @@ def main():
         pygame.K_RETURN: 6,
     }
 
-    # Record actions of the playthrough
+    # Record actions of the playthrough and every key press with its timestamp
     actions = []
-    debounce_time = 0.1  # 100 ms
+    key_presses = []
+    debounce_time = 0.1  # 100 ms, repeat interval while a key is held
     last_action_time = 0
 
-    # Load preloaded actions if resume argument is provided
+    # Continue from the actions of a crashed session recovered from its journal, otherwise
+    # load preloaded actions if resume argument is provided
     preloaded_actions = []
-    if args.resume:
+    if recovered_actions:
+        print(f"Recovered {len(recovered_actions)} actions from {journal_path}")
+        preloaded_actions = recovered_actions
+        actions += preloaded_actions
+        execute_preloaded_actions(env, preloaded_actions)
+    elif args.resume:
         with open(args.resume, 'r') as f:
             preloaded_actions = json.load(f)
             actions += preloaded_actions
@@ -94,6 +191,11 @@ def main():
         actions.append(5)
         obs, reward, _, done, info = env.step(5)
 
+    # Journal every action, a recovered journal already holds its actions
+    journal = ActionJournal(journal_path, fsync_interval=args.fsync_interval)
+    for action in actions[len(recovered_actions):]:
+        journal.append(action)
+
     # Initialize Pygame
     pygame.init()
     scale_factor = 10
@@ -103,29 +205,33 @@ def main():
     clock = pygame.time.Clock()
 
     # Initial render
-    frame = process_frame(env.render(reduce_res=False))
-    scale_factor = 1
-    update_screen(screen, frame, screen_width, screen_height)
+    presenter = FramePresenter(screen)
+    autosaver = Autosaver(
+        env,
+        Path("./session/autosave") / Path(args.name).stem,
+        every_actions=args.autosave_every,
+        every_seconds=args.autosave_seconds,
+        keep=args.autosave_keep,
+    )
+    emulator = EmulatorThread(env, actions, journal, autosaver)
+    presenter.present(emulator.frame)
+    shown_frame_id = emulator.frame_id
 
     print("Ready to play!")
     print("Press P to take a screenshot of the game screen.")
 
+    emulator.start()
+
+    def press(action):
+        key_presses.append({"time": time.time(), "action": action})
+        emulator.push(action)
+
     try:
         done = False
-        while not done:
-            # Check for pressed keys and set the corresponding action
-            action = -1
+        while not done and not emulator.done:
             current_time = pygame.time.get_ticks() / 1000  # Convert to seconds
-            if current_time - last_action_time > debounce_time:
-                keys = pygame.key.get_pressed()
-                for key, mapped_action in action_mapping.items():
-                    if keys[key]:
-                        action = mapped_action
-                        actions.append(action)
-                        last_action_time = current_time
-                        break
 
-            # Process events
+            # Process events, new key presses are queued immediately
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     done = True
@@ -138,31 +244,54 @@ def main():
                         screenshot_filename = f"screenshot_{timestamp}.png"
                         pygame.image.save(screen, screenshot_filename)
                         print(f"Screenshot saved to {screenshot_filename}")
+                    elif event.key in action_mapping:
+                        press(action_mapping[event.key])
+                        last_action_time = current_time
 
-            # If no valid action is pressed, continue
-            if action == -1:
-                continue
-
-            # Step the environment
-            obs, reward, _, done, info = env.step(action)
+            # Held keys repeat the action after the debounce time, but only once the emulator
+            # has caught up, so slow steps do not pile up moves that run after the key is released
+            if current_time - last_action_time > debounce_time and not emulator.inputs:
+                keys = pygame.key.get_pressed()
+                for key, mapped_action in action_mapping.items():
+                    if keys[key]:
+                        press(mapped_action)
+                        last_action_time = current_time
+                        break
 
-            # Render the environment using pygame
-            frame = process_frame(env.render(reduce_res=False))
-            update_screen(screen, frame, screen_width, screen_height)
+            # Render the latest emulator frame
+            if emulator.frame_id != shown_frame_id:
+                shown_frame_id = emulator.frame_id
+                presenter.present(emulator.frame)
 
-            # Control the frame rate
-            clock.tick(12)
+            # Poll input at a high rate, emulation runs independently
+            clock.tick(60)
 
     except KeyboardInterrupt:
         print("Process interrupted, exiting...")
 
     finally:
+        # Execute the remaining queued inputs so that every recorded key press is replayed
+        emulator.stop()
+        emulator.join()
+        journal.close()
+        autosaver.close()
         pygame.quit()
+
+    # The journal is kept, the session can be recovered from it
+    if emulator.error is not None:
+        raise emulator.error
     
     # Save the actions
     with open(args.name.replace(".pkl", ".json"), "w") as f:
         json.dump(actions, f)
         print(f"Actions saved to {args.name.replace('.pkl', '.json')}")
 
+    # The journal is only needed to recover from a crash
+    journal_path.unlink()
+
+    # Save the timestamped key presses
+    with open(args.name.replace(".pkl", ".json").replace(".json", "_inputs.json"), "w") as f:
+        json.dump(key_presses, f)
+
 if __name__ == "__main__":
     main()
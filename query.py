@@ -0,0 +1,157 @@
+import argparse
+import operator
+import re
+from collections import defaultdict
+from pathlib import Path
+
+import numpy as np
+
+from replay_common import load_actions, make_config
+from replay_env import ReplayEnv
+from trajectory import TRAJECTORY_COLUMNS, load_trajectory
+
+# per-step columns with one value per party slot and their width, they must be indexed,
+# e.g. party_levels[0]
+INDEXED_COLUMNS = {"party_levels": 6}
+
+OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<=": operator.le,
+    ">=": operator.ge,
+    "<": operator.lt,
+    ">": operator.gt,
+}
+
+TERM_PATTERN = re.compile(r"^\s*(\w+)(?:\[(\d+)\])?\s*(==|!=|<=|>=|<|>)\s*(-?(?:\d+\.?\d*|\.\d+))\s*$")
+
+
+def parse_query(query):
+    # "map == 59 and hp_fraction < 0.2 and party_levels[0] >= 10" -> [(column, index, op, value)]
+    terms = []
+    for term in re.split(r"\band\b", query):
+        match = TERM_PATTERN.match(term)
+        if match is None:
+            raise ValueError(f"Cannot parse query term: {term.strip()}")
+        column, index, op, value = match.groups()
+        if column not in TRAJECTORY_COLUMNS and column != "step":
+            raise ValueError(f"Unknown column: {column}")
+        if column in INDEXED_COLUMNS and index is None:
+            raise ValueError(f"Column {column} needs an index, e.g. {column}[0]")
+        if column not in INDEXED_COLUMNS and index is not None:
+            raise ValueError(f"Column {column} cannot be indexed")
+        if index is not None and int(index) >= INDEXED_COLUMNS[column]:
+            raise ValueError(f"Index {index} of {column} is out of range, it has {INDEXED_COLUMNS[column]} values")
+        value = float(value)
+        if column == "map" and not value.is_integer():
+            raise ValueError(f"Map ids are integers: {term.strip()}")
+        terms.append((column, None if index is None else int(index), op, value))
+    return terms
+
+
+class Corpus:
+    # all trajectory indexes concatenated into one set of columns, with a map id -> rows index
+    def __init__(self, replay_paths, rom, state):
+        self.replay_paths = [str(p) for p in replay_paths]
+        trajectories = [load_trajectory(p, rom, state) for p in self.replay_paths]
+        self.columns = {
+            key: np.concatenate([t[key] for t in trajectories]) for key in TRAJECTORY_COLUMNS
+        }
+        lengths = [len(t["map"]) for t in trajectories]
+        self.replay_id = np.repeat(np.arange(len(trajectories), dtype=np.int32), lengths)
+        self.columns["step"] = np.concatenate([np.arange(n, dtype=np.int32) for n in lengths])
+        # inverted index: rows of map m are map_rows[map_offsets[m]:map_offsets[m + 1]]
+        self.map_rows = np.argsort(self.columns["map"], kind="stable")
+        self.map_offsets = np.searchsorted(self.columns["map"][self.map_rows], np.arange(257))
+
+    def __len__(self):
+        return len(self.replay_id)
+
+    def rows_for_maps(self, map_ids):
+        if not map_ids:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([
+            self.map_rows[self.map_offsets[m]:self.map_offsets[m + 1]] for m in map_ids
+        ])
+
+    def query(self, query):
+        # returns (replay path, step) pairs of all steps matching every term
+        terms = parse_query(query) if isinstance(query, str) else query
+        map_terms = [t for t in terms if t[0] == "map" and t[2] == "=="]
+        if map_terms:
+            map_ids = {int(map_terms[0][3])}
+            for term in map_terms[1:]:
+                map_ids &= {int(term[3])}
+            rows = np.sort(self.rows_for_maps([m for m in map_ids if 0 <= m < 256]))
+            terms = [t for t in terms if t not in map_terms]
+        else:
+            rows = np.arange(len(self))
+        for column, index, op, value in terms:
+            if len(rows) == 0:
+                break
+            values = self.columns[column][rows]
+            if values.ndim == 2:
+                values = values[:, index]
+            rows = rows[OPERATORS[op](values, value)]
+        return [(self.replay_paths[r], int(s)) for r, s in zip(self.replay_id[rows], self.columns["step"][rows])]
+
+
+def export_savestates(results, rom, state, out_dir):
+    # replays each file once and saves a savestate at every requested step
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    steps_by_replay = defaultdict(set)
+    for replay_path, step in results:
+        steps_by_replay[replay_path].add(step)
+    exported = []
+    for replay_path, steps in steps_by_replay.items():
+        env = ReplayEnv(config=make_config(rom, state, headless=True))
+        env.reset()
+        actions = load_actions(replay_path)
+        for step in range(max(steps) + 1):
+            if step > 0:
+                env.step(actions[step - 1])
+            if step in steps:
+                path = out_dir / f"{Path(replay_path).stem}_{step}.state"
+                env.save_state(path)
+                exported.append(path)
+        env.close()
+    return exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the trajectory indexes of all replays')
+    parser.add_argument('query', type=str, help='Conditions joined by "and", e.g. "map == 59 and hp_fraction < 0.2 and badges == 1"')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--limit', type=int, help='Maximum number of results to print', default=50)
+    parser.add_argument('--export', type=str, help='Export savestates of the first matches of every replay to this directory', default=None)
+    parser.add_argument('--per-replay', type=int, help='Number of matches per replay to export', default=1)
+    args = parser.parse_args()
+    # parse before loading the corpus, which may need to build trajectory indexes
+    try:
+        terms = parse_query(args.query)
+    except ValueError as e:
+        parser.error(str(e))
+
+    replay_paths = sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem))
+    corpus = Corpus(replay_paths, args.rom, args.state)
+    results = corpus.query(terms)
+    print(f"{len(results)} of {len(corpus)} steps match")
+    for replay_path, step in results[:args.limit]:
+        print(f"{replay_path} {step}")
+
+    if args.export is not None:
+        selected = []
+        counts = defaultdict(int)
+        for replay_path, step in results:
+            if counts[replay_path] < args.per_replay:
+                counts[replay_path] += 1
+                selected.append((replay_path, step))
+        for path in export_savestates(selected, args.rom, args.state, args.export):
+            print(f"Saved {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,4 @@
+import io
 import uuid
 import math
 from pathlib import Path
@@ -13,26 +14,114 @@ import random
 from gymnasium import Env, spaces
 from pyboy.utils import WindowEvent
 from global_map import local_to_global, GLOBAL_MAP_SHAPE
-from events import events, create_event_flag_mask
+from events import events, create_event_flag_mask, event_bit_table
+from event_hooks import DEFAULT_SCAN_INTERVAL, EventFlagMonitor
+from savestate_store import SavestateStore
+from step_history import StepHistory
 
 event_flags_start = 0xD747
 event_flags_end = 0xD887
 museum_ticket = (0xD754, 0)
+# set bits of every byte value, for counting event flags
+POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.int32)
+PARTY_LEVEL_ADDRESSES = [0xD18C, 0xD1B8, 0xD1E4, 0xD210, 0xD23C, 0xD268]
 
 MAP_N_ADDRESS = 0xD35E
 
+VALID_ACTIONS = [
+    WindowEvent.PRESS_ARROW_DOWN,
+    WindowEvent.PRESS_ARROW_LEFT,
+    WindowEvent.PRESS_ARROW_RIGHT,
+    WindowEvent.PRESS_ARROW_UP,
+    WindowEvent.PRESS_BUTTON_A,
+    WindowEvent.PRESS_BUTTON_B,
+    WindowEvent.PRESS_BUTTON_START,
+]
+
+RELEASE_ACTIONS = [
+    WindowEvent.RELEASE_ARROW_DOWN,
+    WindowEvent.RELEASE_ARROW_LEFT,
+    WindowEvent.RELEASE_ARROW_RIGHT,
+    WindowEvent.RELEASE_ARROW_UP,
+    WindowEvent.RELEASE_BUTTON_A,
+    WindowEvent.RELEASE_BUTTON_B,
+    WindowEvent.RELEASE_BUTTON_START
+]
+
+
+def load_init_states(init_state):
+    # init_state may be a savestate file, a directory of .state files,
+    # a list of savestate files or a SavestateStore pack (.states)
+    if isinstance(init_state, (list, tuple)):
+        paths = [Path(p) for p in init_state]
+    elif Path(init_state).is_dir():
+        paths = sorted(Path(init_state).glob("*.state"))
+    else:
+        paths = [Path(init_state)]
+    states = []
+    for path in paths:
+        if path.suffix == ".states":
+            store = SavestateStore(path, read_only=True)
+            states += [store.get(i) for i in range(len(store))]
+            store.close()
+        else:
+            states.append(path.read_bytes())
+    if not states:
+        raise ValueError(f"No savestates found in {init_state}")
+    return states
+
+
+class UniformSampler:
+    def __call__(self, num_states):
+        return random.randrange(num_states)
+
+
+class WeightedSampler:
+    def __init__(self, weights):
+        self.weights = weights
+
+    def __call__(self, num_states):
+        return random.choices(range(num_states), weights=self.weights)[0]
+
+
+class RoundRobinSampler:
+    def __init__(self):
+        self.next_index = 0
+
+    def __call__(self, num_states):
+        index = self.next_index % num_states
+        self.next_index += 1
+        return index
+
+
+def make_init_state_sampler(sampler, weights=None):
+    # sampler is "uniform", "weighted", "round_robin" or a callable mapping num_states to an index
+    if callable(sampler):
+        return sampler
+    if sampler == "uniform":
+        return UniformSampler()
+    if sampler == "weighted":
+        if weights is None:
+            raise ValueError("init_state_weights are required for the weighted sampler")
+        return WeightedSampler(weights)
+    if sampler == "round_robin":
+        return RoundRobinSampler()
+    raise ValueError(f"Unknown init state sampler: {sampler}")
+
+
 class RedGymEnv(Env):
     def __init__(self, config=None):
         self.s_path = config["session_path"]
         self.save_final_state = config["save_final_state"]
         self.print_rewards = config["print_rewards"]
-        self.headless = config["headless"]
-        self.init_state = config["init_state"]
-        self.act_freq = config["action_freq"]
         self.max_steps_config = config["max_steps"]
         self.max_steps = max(self.max_steps_config) if isinstance(self.max_steps_config, list) else self.max_steps_config
         self.save_video = config["save_video"]
         self.fast_video = config["fast_video"]
+        # per-step agent_stats history: "memory", "spill" (to session_path) or "drop"
+        self.agent_stats_policy = config.get("agent_stats_policy", "memory")
+        self.agent_stats_chunk_size = config.get("agent_stats_chunk_size", 1024)
+        self.agent_stats = None
         self.frame_stacks = 3
         
         # reset parameters (except init state and max steps)
@@ -68,25 +157,8 @@ class RedGymEnv(Env):
         self.metadata = {"render.modes": []}
         self.reward_range = (0, 15000)
         
-        self.valid_actions = [
-            WindowEvent.PRESS_ARROW_DOWN,
-            WindowEvent.PRESS_ARROW_LEFT,
-            WindowEvent.PRESS_ARROW_RIGHT,
-            WindowEvent.PRESS_ARROW_UP,
-            WindowEvent.PRESS_BUTTON_A,
-            WindowEvent.PRESS_BUTTON_B,
-            WindowEvent.PRESS_BUTTON_START,
-        ]
-
-        self.release_actions = [
-            WindowEvent.RELEASE_ARROW_DOWN,
-            WindowEvent.RELEASE_ARROW_LEFT,
-            WindowEvent.RELEASE_ARROW_RIGHT,
-            WindowEvent.RELEASE_ARROW_UP,
-            WindowEvent.RELEASE_BUTTON_A,
-            WindowEvent.RELEASE_BUTTON_B,
-            WindowEvent.RELEASE_BUTTON_START
-        ]
+        self.valid_actions = list(VALID_ACTIONS)
+        self.release_actions = list(RELEASE_ACTIONS)
 
         # load event names (parsed from https://github.com/pret/pokered/blob/91dc3c9f9c8fd529bb6e8307b58b96efa0bec67e/constants/event_constants.asm)
         self.event_names = events
@@ -117,6 +189,20 @@ class RedGymEnv(Env):
             obs_spaces["recent_actions"] = spaces.Box(low=0, high=1, shape=(len(self.valid_actions) * self.frame_stacks,), dtype=np.uint8)
         self.observation_space = spaces.Dict(obs_spaces)
 
+        self._init_emulator(config)
+
+    def _init_emulator(self, config):
+        # setup shared with ReplayEnv: start states, PyBoy, the per-step cache and event hooks
+        self.headless = config["headless"]
+        self.init_state = config["init_state"]
+        # all start states are kept in memory, reset() picks one through the sampler
+        self.init_states = load_init_states(self.init_state) if self.init_state is not None else []
+        self.init_state_sampler = make_init_state_sampler(
+            config.get("init_state_sampler", "uniform"), config.get("init_state_weights")
+        )
+        self.init_state_index = None
+        self.act_freq = config["action_freq"]
+
         head = "null" if config["headless"] else "SDL2"
 
         #log_level("ERROR")
@@ -130,16 +216,27 @@ class RedGymEnv(Env):
         if not config["headless"]:
             self.pyboy.set_emulation_speed(12)
 
+        self.init_step_cache()
+
+        # opt-in event flag change notifications
+        self.event_monitor = None
+        if config.get("event_hooks", False):
+            self.event_monitor = EventFlagMonitor(self, scan_interval=config.get("event_scan_interval", DEFAULT_SCAN_INTERVAL))
+
     def reset(self, seed=None, options={}):
         self.seed = seed
         # restart game, skipping credits
-        if self.init_state is not None:
-            with open(self.init_state, "rb") as f:
-                self.pyboy.load_state(f)
+        self.load_init_state()
 
         self.init_map_mem()
 
-        self.agent_stats = []
+        if self.agent_stats is not None:
+            self.agent_stats.close()
+        self.agent_stats = StepHistory(
+            self.agent_stats_policy,
+            self.agent_stats_chunk_size,
+            Path(self.s_path) / "agent_stats" / f"agent_stats_{self.instance_id}_{self.reset_count}.jsonl",
+        )
 
         self.explore_map = np.zeros(GLOBAL_MAP_SHAPE, dtype=np.uint8)
 
@@ -163,12 +260,21 @@ class RedGymEnv(Env):
         self.visited_mt_moon = 0
         self.visited_cerulean = 0
 
-        self.base_event_flags = sum([
-                self.bit_count(self.read_m(i))
-                for i in range(event_flags_start, event_flags_end)
-        ])
+        # reward inputs of the last computation, components are only recomputed when they change
+        self.reward_event_bytes = None
+        self.reward_event_count = 0
+        self.reward_levels = None
 
+        self.base_event_flags = int(POPCOUNT[self.read_event_bytes()].sum())
+
+        # create a map of all event flags set, with names where possible
         self.current_event_flags_set = {}
+        self.quiet_signature = None
+        self.quiet_signature_step = None
+        self.last_event_bytes = np.zeros(event_flags_end - event_flags_start, dtype=np.uint8)
+        self.update_event_flags_set()
+        if self.event_monitor is not None:
+            self.event_monitor.reset()
 
         # Set or sample max episode steps
         if isinstance(self.max_steps_config, int):
@@ -185,6 +291,53 @@ class RedGymEnv(Env):
         self.reset_count += 1
         return self._get_obs(), {}
 
+    def load_init_state(self):
+        if self.init_states:
+            self.init_state_index = self.init_state_sampler(len(self.init_states))
+            self.load_state(io.BytesIO(self.init_states[self.init_state_index]))
+
+    def load_state(self, file_like):
+        # PyBoy keeps its frame count on load, so the derived values are dropped here
+        self.pyboy.load_state(file_like)
+        self.invalidate_step_cache()
+
+    def restore_state(self, file_like, step_count):
+        # continues after reset() from a savestate taken at step_count of an episode, like a
+        # replay checkpoint. Accumulated stats and rewards count from here.
+        self.load_state(file_like)
+        self.step_count = step_count
+        self.sync_step_baselines()
+
+    def sync_step_baselines(self):
+        # values compared against the previous step describe the loaded RAM again
+        self.last_health = self.read_hp_fraction()
+        self.party_size = self.read_m(0xD163)
+        self.get_levels_sum()
+        self.quiet_signature = None
+        self.quiet_signature_step = None
+        self.update_event_flags_set()
+        if self.event_monitor is not None:
+            self.event_monitor.reset()
+
+    def init_step_cache(self):
+        self.emulator_ticking = False
+        self.invalidate_step_cache()
+
+    def invalidate_step_cache(self):
+        self.step_cache = {}
+        self.step_cache_frame = self.pyboy.frame_count
+
+    def memoized(self, key, compute):
+        # derived values are computed once per emulator state. The cache is dropped whenever
+        # the frame count moves, hooks that run during a tick always compute fresh values.
+        if self.emulator_ticking:
+            return compute()
+        if self.pyboy.frame_count != self.step_cache_frame:
+            self.invalidate_step_cache()
+        if key not in self.step_cache:
+            self.step_cache[key] = compute()
+        return self.step_cache[key]
+
     def init_map_mem(self):
         self.seen_coords = {}
 
@@ -201,9 +354,7 @@ class RedGymEnv(Env):
         self.update_recent_screens(screen)
         
         # normalize to approx 0-1
-        levels =  np.asarray([
-            self.read_m(a) for a in [0xD18C, 0xD1B8, 0xD1E4, 0xD210, 0xD23C, 0xD268]
-        ])
+        levels = np.asarray(self.read_party_levels())
 
         unmasked_events = np.array(self.read_event_bits(), dtype=np.int8)
         masked_events = unmasked_events[self.events_mask]
@@ -238,6 +389,40 @@ class RedGymEnv(Env):
             self.start_video()
 
         self.run_action_on_emulator(action)
+        return self.update_after_action(action)
+
+    def step_quiet(self, action):
+        # replay fast path: when none of the RAM the per-step bookkeeping depends on changed,
+        # only advance the step counter and return None, otherwise finish a regular step
+        if self.save_video:
+            return self.step(action)
+        if self.quiet_signature_step != self.step_count:
+            self.quiet_signature = self.read_step_signature()
+        self.run_action_on_emulator(action)
+        signature = self.read_step_signature()
+        if np.array_equal(signature, self.quiet_signature):
+            x_pos, y_pos, map_n = self.get_game_coords()
+            self.seen_coords[f"x:{x_pos} y:{y_pos} m:{map_n}"] = self.step_count
+            self.step_count += 1
+            self.quiet_signature_step = self.step_count
+            return None
+        result = self.update_after_action(action)
+        self.quiet_signature = signature
+        self.quiet_signature_step = self.step_count
+        return result
+
+    def read_step_signature(self):
+        # party (count, species, hp, levels), event flags, badges, coords and opponent levels
+        memory = self.pyboy.memory
+        return np.array(
+            memory[0xD163:0xD26B]
+            + memory[event_flags_start:event_flags_end]
+            + [memory[a] for a in [0xD356, 0xD35E, 0xD361, 0xD362]]
+            + [memory[a] for a in [0xD8C5, 0xD8F1, 0xD91D, 0xD949, 0xD975, 0xD9A1]],
+            dtype=np.uint8,
+        )
+
+    def update_after_action(self, action):
         self.append_agent_stats(action)
 
         self.update_recent_actions(action)
@@ -260,19 +445,9 @@ class RedGymEnv(Env):
 
         obs = self._get_obs()
 
-        # create a map of all event flags set, with names where possible
-        #if step_limit_reached:
-        if self.step_count % 100 == 0:
-            for address in range(event_flags_start, event_flags_end):
-                val = self.read_m(address)
-                for idx, bit in enumerate(f"{val:08b}"):
-                    if bit == "1":
-                        # TODO this currently seems to be broken!
-                        key = f"0x{address:X}-{idx}"
-                        if key in self.event_names.keys():
-                            self.current_event_flags_set[key] = self.event_names[key]
-                        else:
-                            print(f"could not find key: {key}")
+        self.update_event_flags_set()
+        if self.event_monitor is not None:
+            self.event_monitor.after_step()
 
         if self.get_badges() > self.num_badges:
             self.num_badges = self.get_badges()
@@ -313,18 +488,20 @@ class RedGymEnv(Env):
         # disable rendering when we don't need it
         render_screen = self.save_video or not self.headless
         press_step = 8
-        self.pyboy.tick(press_step, render_screen)
-        self.pyboy.send_input(self.release_actions[action])
-        self.pyboy.tick(self.act_freq - press_step - 1, render_screen)
-        self.pyboy.tick(1, True)
+        self.emulator_ticking = True
+        try:
+            self.pyboy.tick(press_step, render_screen)
+            self.pyboy.send_input(self.release_actions[action])
+            self.pyboy.tick(self.act_freq - press_step - 1, render_screen)
+            self.pyboy.tick(1, True)
+        finally:
+            self.emulator_ticking = False
         if self.save_video and self.fast_video:
             self.add_video_frame()
 
     def append_agent_stats(self, action):
         x_pos, y_pos, map_n = self.get_game_coords()
-        levels = [
-            self.read_m(a) for a in [0xD18C, 0xD1B8, 0xD1E4, 0xD210, 0xD23C, 0xD268]
-        ]
+        levels = list(self.read_party_levels())
         self.agent_stats.append(
             {
                 "step": self.step_count,
@@ -404,6 +581,9 @@ class RedGymEnv(Env):
         return buckets / self.bucket_size
 
     def get_game_coords(self):
+        return self.memoized("coords", self.read_game_coords)
+
+    def read_game_coords(self):
         return (self.read_m(0xD362), self.read_m(0xD361), self.read_m(0xD35E))
 
     def update_seen_coords(self):
@@ -475,6 +655,26 @@ class RedGymEnv(Env):
         # add padding so zero will read '0b100000000' instead of '0b0'
         return bin(256 + self.read_m(addr))[-bit - 1] == "1"
 
+    def read_event_bytes(self):
+        return np.array(self.pyboy.memory[event_flags_start:event_flags_end], dtype=np.uint8)
+
+    def update_event_flags_set(self):
+        # only visit the bits that changed since the last call
+        event_bytes = self.read_event_bytes()
+        if np.array_equal(event_bytes, self.last_event_bytes):
+            return
+        changed_bits = np.flatnonzero(
+            np.unpackbits(event_bytes ^ self.last_event_bytes, bitorder="little")
+        )
+        set_bits = np.unpackbits(event_bytes, bitorder="little")
+        for idx in changed_bits:
+            key, name = event_bit_table[idx]
+            if set_bits[idx]:
+                self.current_event_flags_set[key] = name
+            else:
+                self.current_event_flags_set.pop(key, None)
+        self.last_event_bytes = event_bytes
+
     def read_event_bits(self):
         return [
             int(bit) for i in range(event_flags_start, event_flags_end) 
@@ -482,14 +682,21 @@ class RedGymEnv(Env):
         ]
 
     def get_levels_sum(self):
+        self.last_level_max_sum = self.memoized("levels_sum", self.compute_levels_sum)
+        return self.last_level_max_sum
+
+    def compute_levels_sum(self):
         min_poke_level = 2
         starter_additional_levels = 4
-        poke_levels = [
-            max(self.read_m(a) - min_poke_level, 0)
-            for a in [0xD18C, 0xD1B8, 0xD1E4, 0xD210, 0xD23C, 0xD268]
-        ]
-        self.last_level_max_sum = max(sum(poke_levels) - starter_additional_levels, 0)
-        return self.last_level_max_sum
+        levels = self.read_party_levels()
+        if levels != self.reward_levels:
+            self.reward_levels = levels
+            poke_levels = [max(level - min_poke_level, 0) for level in levels]
+            self.reward_levels_sum = max(sum(poke_levels) - starter_additional_levels, 0)
+        return self.reward_levels_sum
+
+    def read_party_levels(self):
+        return self.memoized("party_levels", lambda: tuple(self.read_m(a) for a in PARTY_LEVEL_ADDRESSES))
 
     def get_levels_reward(self):
         explore_thresh = 22
@@ -512,16 +719,16 @@ class RedGymEnv(Env):
         ]
 
     def get_all_events_reward(self):
-        # adds up all event flags, exclude museum ticket
-        return max(
-            sum([
-                self.bit_count(self.read_m(i))
-                for i in range(event_flags_start, event_flags_end)
-            ])
-            - self.base_event_flags
-            - int(self.read_bit(museum_ticket[0], museum_ticket[1])),
-            0,
-        )
+        # adds up all event flags, exclude museum ticket. The flags are only recounted when
+        # the event bytes changed since the last call.
+        event_bytes = self.read_event_bytes()
+        if self.reward_event_bytes is None or not np.array_equal(event_bytes, self.reward_event_bytes):
+            self.reward_event_bytes = event_bytes
+            museum_byte = event_bytes[museum_ticket[0] - event_flags_start]
+            self.reward_event_count = (
+                int(POPCOUNT[event_bytes].sum()) - int((museum_byte >> museum_ticket[1]) & 1)
+            )
+        return max(self.reward_event_count - self.base_event_flags, 0)
 
     def get_game_state_reward(self, print_stats=False):
         # addresses from https://datacrystal.romhacking.net/wiki/Pok%C3%A9mon_Red/Blue:RAM_map
@@ -567,6 +774,9 @@ class RedGymEnv(Env):
                 self.died_count += 1
 
     def read_hp_fraction(self):
+        return self.memoized("hp_fraction", self.compute_hp_fraction)
+
+    def compute_hp_fraction(self):
         hp_sum = sum([
             self.read_hp(add)
             for add in [0xD16C, 0xD198, 0xD1C4, 0xD1F0, 0xD21C, 0xD248]
@@ -609,6 +819,12 @@ class RedGymEnv(Env):
         else:
             return -1
 
+    def close(self):
+        # writes out the agent_stats history still in memory and stops the emulator
+        if self.agent_stats is not None:
+            self.agent_stats.close()
+        self.pyboy.stop(save=False)
+
     def save_state(self, path):
         with open(path, "wb") as f:
             self.pyboy.save_state(f)
\ No newline at end of file
@@ -1,10 +1,13 @@
 import argparse
-import json
-from pathlib import Path
+from itertools import groupby
 import pprint
 
+import numpy as np
+
 from map_data import map_locations
 from red_gym_env_v2 import RedGymEnv
+from replay_common import compare_infos, load_actions, make_config
+from replay_env import ReplayEnv
 from stats_wrapper import StatsWrapper
 
 
@@ -36,58 +39,50 @@ def print_info_nicely(info):
             print(f"{key:<{max_key_length}} : {value}")
 
 
+def replay_actions(env, actions, fast=False):
+    steps = 0
+    rewards = 0
+    try:
+        if fast:
+            for action, run in groupby(actions):
+                count = len(list(run))
+                obs, reward, truncated, done, info = env.step_run(action, count)
+                steps += count
+                rewards += reward
+        else:
+            for action in actions:
+                obs, reward, truncated, done, info = env.step(action)
+                steps += 1
+                rewards += reward
+
+    except KeyboardInterrupt:
+        print("Process interrupted, exiting...")
+
+    return steps, rewards
+
+
 def main():
     parser = argparse.ArgumentParser(description='Replay actions in Pokemon Red via Gym environment')
     parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
     parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
     parser.add_argument('--name', type=str, help='Path to the actions file', default="playthrough.pkl")
     parser.add_argument('--headless', action='store_true', help="Run Pyboy in headless mode.", default=False)
+    parser.add_argument('--fast', action='store_true', help="Batch runs of identical actions, stats are only computed where RAM changed.", default=False)
+    parser.add_argument('--lightweight', action='store_true', help="Use the minimal ReplayEnv that only tracks what the statistics need.", default=False)
+    parser.add_argument('--verify-fast', action='store_true', help="Replay on both paths and compare the final stats.", default=False)
     args = parser.parse_args()
 
-    config = {
-        "session_path": Path("./session/"),
-        "save_final_state": False,
-        "print_rewards": False,
-        "headless": args.headless,
-        "init_state": args.state,
-        "action_freq": 24,
-        "max_steps": 10280,
-        "save_video": False,
-        "fast_video": False,
-        "gb_path": args.rom,
-        "reset_params": {
-            "reward_scale": 0.5,
-            "event_weight": 4.0,
-            "level_weight": 1.0,
-            "op_lvl_weight": 0.0,
-            "heal_weight": 5.0,
-            "explore_weight": 0.1,
-            "use_explore_map_obs": True,
-            "use_recent_actions_obs": False,
-            "zero_recent_actions": False
-        },
-    }
+    config = make_config(args.rom, args.state, args.headless)
+    env_cls = ReplayEnv if args.lightweight else RedGymEnv
 
     # Initialize the environment
-    env = StatsWrapper(RedGymEnv(config=config))
+    env = StatsWrapper(env_cls(config=config))
     obs, _ = env.reset()
-    steps = 0
-    rewards = 0
     
     # Load actions from file
-    with open(args.name.replace(".pkl", ".json"), "r") as f:
-        actions = json.load(f)
-    
-    try:
-        for action in actions:
-            if action == -1:
-                continue
-            obs, reward, truncated, done, info = env.step(action)
-            steps += 1
-            rewards += reward
+    actions = load_actions(args.name)
 
-    except KeyboardInterrupt:
-        print("Process interrupted, exiting...")
+    steps, rewards = replay_actions(env, actions, fast=args.fast)
 
     print(f"Steps taken: {steps}")
     print(f"Return: {rewards}")
@@ -96,5 +91,17 @@ def main():
     print("Info:")
     print_info_nicely(env.get_info())
 
+    if args.verify_fast:
+        # replay again on the other path and compare the final stats
+        other_env = StatsWrapper(env_cls(config=config))
+        other_env.reset()
+        other_steps, other_rewards = replay_actions(other_env, actions, fast=not args.fast)
+        mismatches = compare_infos(env.get_info(), other_env.get_info())
+        if other_steps != steps or not np.isclose(other_rewards, rewards):
+            mismatches.append(f"return: {rewards} vs {other_rewards}")
+        for mismatch in mismatches:
+            print(f"Mismatch in {mismatch}")
+        print("Fast path matches the step-by-step path" if not mismatches else "Fast path differs!")
+
 if __name__ == "__main__":
     main()
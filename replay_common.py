@@ -0,0 +1,52 @@
+import json
+from pathlib import Path
+
+import numpy as np
+
+# Replay file loading and the env config shared by the replay tools
+
+
+def load_actions(path):
+    with open(str(path).replace(".pkl", ".json"), "r") as f:
+        actions = json.load(f)
+    # -1 marks "no action" and is skipped during replay
+    return [action for action in actions if action != -1]
+
+
+def make_config(rom, state, headless=True):
+    return {
+        "session_path": Path("./session/"),
+        "save_final_state": False,
+        "print_rewards": False,
+        "headless": headless,
+        "init_state": state,
+        "action_freq": 24,
+        "max_steps": 10280,
+        "save_video": False,
+        "fast_video": False,
+        "gb_path": rom,
+        "reset_params": {
+            "reward_scale": 0.5,
+            "event_weight": 4.0,
+            "level_weight": 1.0,
+            "op_lvl_weight": 0.0,
+            "heal_weight": 5.0,
+            "explore_weight": 0.1,
+            "use_explore_map_obs": True,
+            "use_recent_actions_obs": False,
+            "zero_recent_actions": False
+        },
+    }
+
+
+def compare_infos(info, other_info):
+    mismatches = []
+    for key, value in info.items():
+        other_value = other_info[key]
+        if isinstance(value, np.ndarray):
+            equal = np.array_equal(value, other_value)
+        else:
+            equal = value == other_value
+        if not equal:
+            mismatches.append(f"{key}: {value} vs {other_value}")
+    return mismatches
@@ -0,0 +1,130 @@
+import argparse
+from bisect import bisect_left
+from pathlib import Path
+
+import numpy as np
+
+from events import event_bit_table
+from map_data import map_locations
+from replay_common import load_actions
+from trajectory import load_trajectory
+
+
+def first_divergence(a, b):
+    # first index where two equally indexed sequences differ, None if one is a prefix of the other
+    n = min(len(a), len(b))
+    diff = np.flatnonzero(np.asarray(a[:n]) != np.asarray(b[:n]))
+    return int(diff[0]) if len(diff) else None
+
+
+def first_visits(map_n):
+    maps, steps = np.unique(map_n, return_index=True)
+    return dict(zip(maps.tolist(), steps.tolist()))
+
+
+def milestones(trajectory):
+    # (kind, id) -> first step, for events set during the replay and first map visits
+    result = {}
+    for bit in np.flatnonzero(trajectory["event_first_step"] > 0):
+        result[("event", int(bit))] = int(trajectory["event_first_step"][bit])
+    for map_n, step in first_visits(trajectory["map"]).items():
+        result[("map", map_n)] = step
+    return result
+
+
+def milestone_name(milestone):
+    kind, value = milestone
+    if kind == "event":
+        return event_bit_table[value][1]
+    return f"Map {map_locations.get(value, value)}"
+
+
+def align_milestones(milestones_a, milestones_b):
+    # anchors are the milestones reached in both replays, ordered by replay a. Anchors that
+    # happen in a different order in replay b are dropped by keeping the longest increasing
+    # subsequence of their steps in b.
+    common = sorted(set(milestones_a) & set(milestones_b), key=lambda m: (milestones_a[m], milestones_b[m]))
+    steps_b = [milestones_b[m] for m in common]
+    tails, tails_idx, prev = [], [], [-1] * len(common)
+    for i, step in enumerate(steps_b):
+        pos = bisect_left(tails, step)
+        if pos == len(tails):
+            tails.append(step)
+            tails_idx.append(i)
+        else:
+            tails[pos] = step
+            tails_idx[pos] = i
+        prev[i] = tails_idx[pos - 1] if pos > 0 else -1
+    anchors = []
+    i = tails_idx[-1] if tails_idx else -1
+    while i != -1:
+        anchors.append(common[i])
+        i = prev[i]
+    return anchors[::-1]
+
+
+def print_report(name_a, name_b, actions_a, actions_b, traj_a, traj_b, top_maps):
+    print(f"A: {name_a} ({len(actions_a)} steps)")
+    print(f"B: {name_b} ({len(actions_b)} steps)")
+
+    action_div = first_divergence(actions_a, actions_b)
+    position_a = np.stack([traj_a["map"], traj_a["x"], traj_a["y"]], axis=1)
+    position_b = np.stack([traj_b["map"], traj_b["x"], traj_b["y"]], axis=1)
+    n = min(len(position_a), len(position_b))
+    mismatch = np.flatnonzero(np.any(position_a[:n] != position_b[:n], axis=1))
+    position_div = int(mismatch[0]) if len(mismatch) else None
+    print(f"Actions identical up to step: {action_div if action_div is not None else min(len(actions_a), len(actions_b))}")
+    print(f"Positions identical up to step: {position_div if position_div is not None else n}")
+
+    milestones_a = milestones(traj_a)
+    milestones_b = milestones(traj_b)
+    anchors = align_milestones(milestones_a, milestones_b)
+    print(f"\nAligned milestones ({len(anchors)} anchors):")
+    print(f"{'milestone':<45} {'A':>8} {'B':>8} {'B - A':>8} {'segment A':>10} {'segment B':>10}")
+    last_a = last_b = 0
+    for milestone in anchors:
+        step_a, step_b = milestones_a[milestone], milestones_b[milestone]
+        print(
+            f"{milestone_name(milestone)[:45]:<45} {step_a:>8} {step_b:>8} {step_b - step_a:>8}"
+            f" {step_a - last_a:>10} {step_b - last_b:>10}"
+        )
+        last_a, last_b = step_a, step_b
+    only_a = sorted(set(milestones_a) - set(milestones_b), key=milestones_a.get)
+    only_b = sorted(set(milestones_b) - set(milestones_a), key=milestones_b.get)
+    if only_a:
+        print("\nOnly in A: " + ", ".join(f"{milestone_name(m)} @ {milestones_a[m]}" for m in only_a))
+    if only_b:
+        print("\nOnly in B: " + ", ".join(f"{milestone_name(m)} @ {milestones_b[m]}" for m in only_b))
+
+    steps_a = np.bincount(traj_a["map"], minlength=256)
+    steps_b = np.bincount(traj_b["map"], minlength=256)
+    order = np.argsort(-(steps_a + steps_b))[:top_maps]
+    print(f"\nSteps per map (top {top_maps}):")
+    print(f"{'map':<30} {'A':>8} {'B':>8} {'B - A':>8}")
+    for map_n in order:
+        if steps_a[map_n] + steps_b[map_n] == 0:
+            break
+        name = map_locations.get(int(map_n), str(map_n))
+        print(f"{name[:30]:<30} {steps_a[map_n]:>8} {steps_b[map_n]:>8} {steps_b[map_n] - steps_a[map_n]:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the location and event timelines of two replays')
+    parser.add_argument('replay_a', type=str, help='Path to the first replay')
+    parser.add_argument('replay_b', type=str, help='Path to the second replay')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--top-maps', type=int, help='Number of maps to list in the time per map table', default=20)
+    args = parser.parse_args()
+
+    traj_a = load_trajectory(args.replay_a, args.rom, args.state)
+    traj_b = load_trajectory(args.replay_b, args.rom, args.state)
+    print_report(
+        Path(args.replay_a).name, Path(args.replay_b).name,
+        load_actions(args.replay_a), load_actions(args.replay_b),
+        traj_a, traj_b, args.top_maps,
+    )
+
+
+if __name__ == "__main__":
+    main()
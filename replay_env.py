@@ -0,0 +1,148 @@
+import argparse
+import time
+
+import numpy as np
+from gymnasium import spaces
+
+from events import events, create_event_flag_mask
+from red_gym_env_v2 import RedGymEnv, RELEASE_ACTIONS, VALID_ACTIONS
+from replay_common import compare_infos, load_actions, make_config
+from stats_wrapper import StatsWrapper
+
+
+def rl_only(name):
+    # inherited RedGymEnv methods that need the reward, explore map, video or agent_stats state
+    def method(self, *args, **kwargs):
+        raise NotImplementedError(f"ReplayEnv only tracks replay statistics, {name} needs RedGymEnv")
+    method.__name__ = name
+    return method
+
+
+class ReplayEnv(RedGymEnv):
+    # Minimal env for replay statistics. It drives PyBoy with the same inputs and timing as
+    # RedGymEnv but only keeps what StatsWrapper reads: party size, heals, deaths, seen coords,
+    # opponent levels and the event observation. No frame stacks, explore map, rewards or agent_stats.
+    def __init__(self, config=None):
+        self.max_steps_config = config["max_steps"]
+        self.max_steps = max(self.max_steps_config) if isinstance(self.max_steps_config, list) else self.max_steps_config
+        self.save_video = False
+        self.fast_video = False
+        self.agent_stats = None
+
+        self.valid_actions = list(VALID_ACTIONS)
+        self.release_actions = list(RELEASE_ACTIONS)
+        self.action_space = spaces.Discrete(len(self.valid_actions))
+        self.events_mask = create_event_flag_mask(events)
+        self.observation_space = spaces.Dict({
+            "events": spaces.Box(low=0, high=1, shape=(sum(self.events_mask),), dtype=np.uint8),
+        })
+
+        self._init_emulator(config)
+
+    append_agent_stats = rl_only("append_agent_stats")
+    start_video = rl_only("start_video")
+    add_video_frame = rl_only("add_video_frame")
+    get_left_steps_buckets = rl_only("get_left_steps_buckets")
+    update_explore_map = rl_only("update_explore_map")
+    get_explore_map = rl_only("get_explore_map")
+    update_recent_screens = rl_only("update_recent_screens")
+    update_recent_actions = rl_only("update_recent_actions")
+    update_reward = rl_only("update_reward")
+    group_rewards = rl_only("group_rewards")
+    check_if_done = rl_only("check_if_done")
+    get_levels_reward = rl_only("get_levels_reward")
+    get_all_events_reward = rl_only("get_all_events_reward")
+    get_game_state_reward = rl_only("get_game_state_reward")
+    update_max_event_rew = rl_only("update_max_event_rew")
+    update_map_progress = rl_only("update_map_progress")
+    get_map_progress = rl_only("get_map_progress")
+
+    def reset(self, seed=None, options={}):
+        self.seed = seed
+        self.load_init_state()
+        self.init_map_mem()
+        self.last_health = 1
+        self.total_healing_rew = 0
+        self.num_heals = 0
+        self.died_count = 0
+        self.party_size = 0
+        self.step_count = 0
+        self.max_opponent_level = 0
+        self.quiet_signature = None
+        self.quiet_signature_step = None
+        self.reward_levels = None
+        # same side effects as the initial reward computation of RedGymEnv
+        self.get_levels_sum()
+        self.update_max_op_level()
+        if self.event_monitor is not None:
+            self.event_monitor.reset()
+        return self._get_obs(), {}
+
+    def update_event_flags_set(self):
+        # event flag names are not tracked
+        pass
+
+    def run_action_on_emulator(self, action):
+        # same input timing as RedGymEnv, but the screen is only rendered for a window
+        render_screen = not self.headless
+        press_step = 8
+        self.pyboy.send_input(self.valid_actions[action])
+        self.emulator_ticking = True
+        try:
+            self.pyboy.tick(press_step, render_screen)
+            self.pyboy.send_input(self.release_actions[action])
+            self.pyboy.tick(self.act_freq - press_step, render_screen)
+        finally:
+            self.emulator_ticking = False
+
+    def _get_obs(self):
+        event_bits = np.unpackbits(self.read_event_bytes(), bitorder="little").astype(np.int8)
+        return {"events": event_bits[self.events_mask]}
+
+    def update_after_action(self, action):
+        # keeps the order of RedGymEnv.update_after_action for everything StatsWrapper reads
+        self.update_seen_coords()
+        self.update_heal_reward()
+        self.party_size = self.read_m(0xD163)
+        # RedGymEnv refreshes last_level_max_sum while computing the level reward
+        self.get_levels_sum()
+        self.last_health = self.read_hp_fraction()
+        obs = self._get_obs()
+        if self.event_monitor is not None:
+            self.event_monitor.after_step()
+        self.step_count += 1
+        return obs, 0, False, False, {}
+
+
+def benchmark(config, actions):
+    infos = []
+    for env_cls in (RedGymEnv, ReplayEnv):
+        env = StatsWrapper(env_cls(config=config))
+        env.reset()
+        start = time.perf_counter()
+        for action in actions:
+            env.step(action)
+        elapsed = time.perf_counter() - start
+        print(f"StatsWrapper({env_cls.__name__}): {len(actions) / elapsed:.1f} steps/s")
+        infos.append(env.get_info())
+        env.close()
+    mismatches = compare_infos(*infos)
+    for mismatch in mismatches:
+        print(f"Mismatch in {mismatch}")
+    print("Stats are identical" if not mismatches else "Stats differ!")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ReplayEnv against RedGymEnv for replay statistics')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--name', type=str, help='Path to the actions file', default="replays/1.json")
+    parser.add_argument('--max-steps', type=int, help='Only replay the first N steps', default=None)
+    args = parser.parse_args()
+
+    config = make_config(args.rom, args.state, headless=True)
+    benchmark(config, load_actions(args.name)[:args.max_steps])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import argparse
+import time
+
+from red_gym_env_v2 import RedGymEnv, event_flags_start, event_flags_end, museum_ticket
+from replay_common import load_actions, make_config
+
+# Replays a file with the incremental reward computation of RedGymEnv and with the
+# original full recomputation side by side and checks that every step reward matches.
+
+
+class UncachedRewardEnv(RedGymEnv):
+    # the reward inputs are read and recomputed on every call, as before the caching
+    def get_levels_sum(self):
+        min_poke_level = 2
+        starter_additional_levels = 4
+        poke_levels = [
+            max(self.read_m(a) - min_poke_level, 0)
+            for a in [0xD18C, 0xD1B8, 0xD1E4, 0xD210, 0xD23C, 0xD268]
+        ]
+        self.last_level_max_sum = max(sum(poke_levels) - starter_additional_levels, 0)
+        return self.last_level_max_sum
+
+    def get_all_events_reward(self):
+        return max(
+            sum([
+                self.bit_count(self.read_m(i))
+                for i in range(event_flags_start, event_flags_end)
+            ])
+            - self.base_event_flags
+            - int(self.read_bit(museum_ticket[0], museum_ticket[1])),
+            0,
+        )
+
+
+def timed_reward_calls(env, repeats=1000):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        env.get_game_state_reward()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the incremental reward computation against a full recomputation')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--name', type=str, help='Path to the actions file', default="replays/1.json")
+    parser.add_argument('--max-steps', type=int, help='Only replay this many steps', default=None)
+    args = parser.parse_args()
+
+    config = make_config(args.rom, args.state, headless=True)
+    cached = RedGymEnv(config=config)
+    reference = UncachedRewardEnv(config=config)
+    cached.reset()
+    reference.reset()
+    mismatches = 0
+    if cached.progress_reward != reference.progress_reward:
+        print(f"reset: {cached.progress_reward} vs {reference.progress_reward}")
+        mismatches += 1
+
+    actions = load_actions(args.name)[:args.max_steps]
+    for step, action in enumerate(actions):
+        _, reward, _, _, _ = cached.step(action)
+        _, reference_reward, _, _, _ = reference.step(action)
+        if reward != reference_reward or cached.progress_reward != reference.progress_reward:
+            mismatches += 1
+            if mismatches <= 10:
+                print(f"step {step}: {reward} vs {reference_reward}, {cached.progress_reward} vs {reference.progress_reward}")
+    print(f"{len(actions)} steps, {mismatches} mismatching rewards")
+    print(
+        f"get_game_state_reward: {timed_reward_calls(cached) * 1e6:.1f}us incremental,"
+        f" {timed_reward_calls(reference) * 1e6:.1f}us full recomputation"
+    )
+    cached.close()
+    reference.close()
+
+
+if __name__ == "__main__":
+    main()
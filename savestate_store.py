@@ -0,0 +1,175 @@
+import argparse
+import io
+import time
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+# Savestate store: every keyframe_interval-th snapshot is stored in full, all others as the
+# XOR against their keyframe. Both are zlib compressed with a fast level. Restoring any
+# snapshot needs at most its keyframe and one delta.
+#
+# <path>     concatenated compressed records
+# <path>.idx one INDEX_DTYPE row per snapshot
+
+INDEX_DTYPE = np.dtype([
+    ("offset", "<u8"),
+    ("size", "<u4"),
+    ("raw_size", "<u4"),
+    ("keyframe", "<u8"),
+])
+
+
+class SavestateStore:
+    def __init__(self, path, keyframe_interval=32, level=1, read_only=False):
+        # read_only opens an existing store without creating or writing any file
+        self.path = Path(path)
+        self.index_path = Path(str(path) + ".idx")
+        self.keyframe_interval = keyframe_interval
+        self.level = level
+        self.read_only = read_only
+        if read_only:
+            self.data_file = open(self.path, "rb")
+            self.index_file = None
+            self.index = list(np.fromfile(self.index_path, dtype=INDEX_DTYPE))
+        else:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.data_file = open(self.path, "a+b")
+            self.index_file = open(self.index_path, "a+b")
+            if self.index_path.stat().st_size:
+                self.index = list(np.fromfile(self.index_path, dtype=INDEX_DTYPE))
+            else:
+                self.index = []
+        self.cached_keyframe_id = None
+        self.cached_keyframe = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def read_record(self, snapshot_id):
+        entry = self.index[snapshot_id]
+        self.data_file.seek(int(entry["offset"]))
+        return np.frombuffer(
+            zlib.decompress(self.data_file.read(int(entry["size"]))), dtype=np.uint8
+        )
+
+    def get_keyframe(self, keyframe_id):
+        if self.cached_keyframe_id != keyframe_id:
+            self.cached_keyframe = self.read_record(keyframe_id)
+            self.cached_keyframe_id = keyframe_id
+        return self.cached_keyframe
+
+    def append(self, state):
+        # state is the bytes of a pyboy savestate, returns its snapshot id
+        if self.read_only:
+            raise ValueError(f"{self.path} is opened read only")
+        snapshot_id = len(self.index)
+        raw = np.frombuffer(state, dtype=np.uint8)
+        if snapshot_id % self.keyframe_interval == 0:
+            keyframe_id = snapshot_id
+            record = raw
+        else:
+            keyframe_id = snapshot_id - snapshot_id % self.keyframe_interval
+            keyframe = self.get_keyframe(keyframe_id)
+            # states of different length are padded with zeros to the longer one
+            length = max(len(raw), len(keyframe))
+            record = np.zeros(length, dtype=np.uint8)
+            record[:len(raw)] = raw
+            record[:len(keyframe)] ^= keyframe
+        compressed = zlib.compress(record.tobytes(), self.level)
+        self.data_file.seek(0, io.SEEK_END)
+        entry = np.array(
+            [(self.data_file.tell(), len(compressed), len(raw), keyframe_id)], dtype=INDEX_DTYPE
+        )
+        self.data_file.write(compressed)
+        self.data_file.flush()
+        self.index_file.write(entry.tobytes())
+        self.index_file.flush()
+        self.index.append(entry[0])
+        if keyframe_id == snapshot_id:
+            self.cached_keyframe_id = snapshot_id
+            self.cached_keyframe = raw.copy()
+        return snapshot_id
+
+    def get(self, snapshot_id):
+        entry = self.index[snapshot_id]
+        keyframe_id = int(entry["keyframe"])
+        if keyframe_id == snapshot_id:
+            return self.get_keyframe(keyframe_id).tobytes()
+        keyframe = self.get_keyframe(keyframe_id)
+        state = self.read_record(snapshot_id).copy()
+        state[:len(keyframe)] ^= keyframe
+        return state[:int(entry["raw_size"])].tobytes()
+
+    def load(self, target, snapshot_id):
+        # target is an env, whose load_state also drops its per-step cache, or a bare PyBoy
+        target.load_state(io.BytesIO(self.get(snapshot_id)))
+
+    def size_on_disk(self):
+        return self.path.stat().st_size + self.index_path.stat().st_size
+
+    def close(self):
+        self.data_file.close()
+        if self.index_file is not None:
+            self.index_file.close()
+
+
+def benchmark(env, actions, every, keyframe_intervals, out_dir):
+    states = []
+    env.reset()
+    for i, action in enumerate(actions):
+        env.step(action)
+        if i % every == 0:
+            state = io.BytesIO()
+            env.pyboy.save_state(state)
+            states.append(state.getvalue())
+    raw_size = np.mean([len(s) for s in states])
+    zlib_size = np.mean([len(zlib.compress(s, 1)) for s in states])
+    print(f"{len(states)} checkpoints every {every} steps")
+    print(f"{'storage':<20} {'bytes/checkpoint':>18} {'restore ms':>12}")
+    print(f"{'raw':<20} {raw_size:>18.0f}")
+    print(f"{'zlib':<20} {zlib_size:>18.0f}")
+    rng = np.random.default_rng(0)
+    for keyframe_interval in keyframe_intervals:
+        path = Path(out_dir) / f"bench_k{keyframe_interval}.states"
+        path.unlink(missing_ok=True)
+        Path(str(path) + ".idx").unlink(missing_ok=True)
+        store = SavestateStore(path, keyframe_interval=keyframe_interval)
+        for state in states:
+            store.append(state)
+        store.close()
+        # reopen to measure cold random access
+        store = SavestateStore(path, keyframe_interval=keyframe_interval)
+        ids = rng.integers(0, len(store), size=min(200, len(store)))
+        start = time.perf_counter()
+        for snapshot_id in ids:
+            store.load(env, int(snapshot_id))
+        restore_ms = (time.perf_counter() - start) / len(ids) * 1000
+        assert all(store.get(i) == states[i] for i in range(len(states)))
+        print(f"{f'delta k={keyframe_interval}':<20} {store.size_on_disk() / len(states):>18.0f} {restore_ms:>12.3f}")
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark delta compressed savestate storage on a replay')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--name', type=str, help='Path to the actions file', default="replays/1.json")
+    parser.add_argument('--every', type=int, help='Take a checkpoint every N steps', default=100)
+    parser.add_argument('--max-steps', type=int, help='Only replay the first N steps', default=None)
+    parser.add_argument('--keyframes', type=int, nargs="+", help='Keyframe intervals to compare', default=[1, 8, 32, 128])
+    parser.add_argument('--out', type=str, help='Directory for the benchmark stores', default="./session/savestate_bench")
+    args = parser.parse_args()
+
+    # imported here since the env itself loads savestate packs through this module
+    from red_gym_env_v2 import RedGymEnv
+    from replay_common import load_actions, make_config
+
+    env = RedGymEnv(config=make_config(args.rom, args.state, headless=True))
+    actions = load_actions(args.name)[:args.max_steps]
+    benchmark(env, actions, args.every, args.keyframes, args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,7 +5,7 @@ from enum import Enum
 import numpy as np
 from gymnasium import Env
 
-from events import filtered_event_names
+from events import create_event_flag_mask, event_bit_table, events, filtered_event_names
 from items import Items
 from map_data import map_locations
 from moves import Moves
@@ -16,6 +16,12 @@ event_flags_start = 0xD747
 event_flags_end = 0xD887
 MAP_N_ADDRESS = 0xD35E
 
+# event bit index -> name, None for unused flags
+event_names_by_bit = [
+    name if used else None
+    for (_, name), used in zip(event_bit_table, create_event_flag_mask(events))
+]
+
 
 class WildEncounterResult(Enum):
     WIN = 0
@@ -34,6 +40,77 @@ class WildEncounter:
     result: WildEncounterResult
 
 
+# one row per wild battle result, species is the internal index (PokedexOrder)
+ENCOUNTER_DTYPE = np.dtype([
+    ("step", np.int32),
+    ("map", np.uint8),
+    ("species", np.uint8),
+    ("level", np.uint8),
+    ("result", np.uint8),
+])
+MERGED_ENCOUNTER_DTYPE = np.dtype(ENCOUNTER_DTYPE.descr + [("replay", np.int32)])
+NUM_ENCOUNTER_RESULTS = len(WildEncounterResult)
+
+
+class EncounterLog:
+    # growable structured array, the capacity doubles when full
+    def __init__(self, capacity=64):
+        self.rows = np.zeros(capacity, dtype=ENCOUNTER_DTYPE)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, step, map_n, species, level, result: WildEncounterResult):
+        if self.size == len(self.rows):
+            self.rows = np.concatenate([self.rows, np.zeros(len(self.rows), dtype=ENCOUNTER_DTYPE)])
+        self.rows[self.size] = (step, map_n, species, level, result.value)
+        self.size += 1
+
+    @property
+    def array(self):
+        return self.rows[:self.size]
+
+    def to_encounters(self):
+        return [
+            WildEncounter(
+                species=PokedexOrder(int(row["species"])),
+                level=int(row["level"]),
+                result=WildEncounterResult(int(row["result"])),
+            )
+            for row in self.array
+        ]
+
+
+def merge_encounter_logs(logs):
+    # concatenates the encounter arrays of several replays, "replay" is the position in logs
+    logs = [log.array if isinstance(log, EncounterLog) else log for log in logs]
+    merged = np.zeros(sum(len(log) for log in logs), dtype=MERGED_ENCOUNTER_DTYPE)
+    offset = 0
+    for replay, log in enumerate(logs):
+        for field in ENCOUNTER_DTYPE.names:
+            merged[field][offset:offset + len(log)] = log[field]
+        merged["replay"][offset:offset + len(log)] = replay
+        offset += len(log)
+    return merged
+
+
+def encounter_result_counts(encounters, by=("species",)):
+    # unique keys of the by fields and a (keys, results) count matrix indexed by WildEncounterResult
+    keys, inverse = np.unique(encounters[list(by)], return_inverse=True)
+    counts = np.bincount(
+        inverse.ravel() * NUM_ENCOUNTER_RESULTS + encounters["result"],
+        minlength=len(keys) * NUM_ENCOUNTER_RESULTS,
+    )
+    return keys, counts.reshape(len(keys), NUM_ENCOUNTER_RESULTS)
+
+
+def encounter_result_rates(encounters, by=("species",)):
+    # same as encounter_result_counts with every row divided by its number of encounters
+    keys, counts = encounter_result_counts(encounters, by)
+    return keys, counts / np.maximum(counts.sum(axis=1, keepdims=True), 1)
+
+
 class StatsWrapper(Env):
     def __init__(self, env: RedGymEnv):
         self.env = env
@@ -65,8 +142,15 @@ class StatsWrapper(Env):
     def reset(self):
         obs, info = self.env.reset()
         self.init_stats_fields(obs["events"])
+        if self.env.event_monitor is not None:
+            self.env.event_monitor.drain()
         return obs, info
 
+    def restore_state(self, file_like, step_count):
+        # see RedGymEnv.restore_state, the stats count from step_count on
+        self.env.restore_state(file_like, step_count)
+        self.init_stats_fields(self.env._get_obs()["events"])
+
     def step(self, action):
         obs, reward, done, truncated, info = self.env.step(action)
         self.update_stats(obs["events"])
@@ -74,9 +158,27 @@ class StatsWrapper(Env):
             info = self.get_info()
         return obs, reward, done, truncated, info
 
+    def step_run(self, action, count):
+        # replays count repeats of the same action, repeats that leave the tracked RAM
+        # unchanged skip the env and stats bookkeeping, the last repeat is a regular step
+        total_reward = 0
+        for _ in range(count - 1):
+            result = self.env.step_quiet(action)
+            if result is None:
+                self.update_location_stats()
+                continue
+            obs, reward, done, truncated, info = result
+            self.update_stats(obs["events"])
+            total_reward += reward
+        obs, reward, done, truncated, info = self.step(action)
+        return obs, total_reward + reward, done, truncated, info
+
     def render(self):
         return self.env.render()
 
+    def close(self):
+        self.env.close()
+
     def init_stats_fields(self, event_obs):
         self.party_size = 1
         self.total_heal = 0
@@ -97,7 +199,7 @@ class StatsWrapper(Env):
         self.pokecenter_count = 0
         self.pokecenter_location_count = defaultdict(int)
         self.item_usage = defaultdict(int)
-        self.wild_encounters: list[WildEncounter] = []
+        self.encounter_log = EncounterLog()
 
     def update_stats(self, event_obs):
         self.party_size = self.env.party_size
@@ -108,20 +210,23 @@ class StatsWrapper(Env):
         self.died_count = self.env.died_count
         self.update_party_levels()
         self.update_location_stats()
-        self.update_event_stats(event_obs)
+        if self.env.event_monitor is not None:
+            self.update_event_stats_from_monitor()
+        else:
+            self.update_event_stats(event_obs)
         self.update_pokedex()
         self.update_time_played()
 
     def update_party_levels(self):
+        # wPartyMon1Level..wPartyMon6Level, read through the env's per-step cache
+        levels = self.env.read_party_levels()
         for i in range(
             self.env.pyboy.memory[self.env.pyboy.symbol_lookup("wPartyCount")[1]]
         ):
-            self.party_levels[i] = self.env.pyboy.memory[
-                self.env.pyboy.symbol_lookup(f"wPartyMon{i+1}Level")[1]
-            ]
+            self.party_levels[i] = levels[i]
 
     def update_location_stats(self):
-        new_location = self.env.read_m(MAP_N_ADDRESS)
+        _, _, new_location = self.env.get_game_coords()
         # Steps needed to reach this location
         if self.location_first_visit_steps[new_location] == -1:
             self.location_first_visit_steps[new_location] = self.env.step_count
@@ -145,6 +250,15 @@ class StatsWrapper(Env):
             self.events_sum += 1
         self.current_events = event_obs
 
+    def update_event_stats_from_monitor(self):
+        # steps are recorded after the env step like in update_event_stats
+        for change in self.env.event_monitor.drain():
+            name = event_names_by_bit[change.bit]
+            if name is None:
+                continue
+            self.events_steps[name] = change.step + 1
+            self.events_sum += 1
+
     def update_pokedex(self):
         # TODO: Make a hook
         _, wPokedexOwned = self.env.pyboy.symbol_lookup("wPokedexOwned")
@@ -169,7 +283,7 @@ class StatsWrapper(Env):
 
     def pokecenter_hook(self, *args, **kwargs):
         self.pokecenter_count += 1
-        map_location = self.env.read_m(MAP_N_ADDRESS)
+        _, _, map_location = self.env.get_game_coords()
         self.pokecenter_location_count[map_location] += 1
 
     def chose_item_hook(self, *args, **kwargs):
@@ -179,12 +293,12 @@ class StatsWrapper(Env):
     def record_battle(self, result: WildEncounterResult):
         _, wEnemyMon = self.env.pyboy.symbol_lookup("wEnemyMon")
         _, wEnemyMon1Level = self.env.pyboy.symbol_lookup("wCurEnemyLevel")
-        self.wild_encounters.append(
-            WildEncounter(
-                species=PokedexOrder(self.env.pyboy.memory[wEnemyMon]),
-                level=self.env.pyboy.memory[wEnemyMon1Level],
-                result=result,
-            )
+        self.encounter_log.append(
+            self.env.step_count,
+            self.env.read_m(MAP_N_ADDRESS),
+            self.env.pyboy.memory[wEnemyMon],
+            self.env.pyboy.memory[wEnemyMon1Level],
+            result,
         )
 
     def record_wild_win_hook(self, *args, **kwargs):
@@ -229,6 +343,7 @@ class StatsWrapper(Env):
             "location_first_visit_steps": self.location_first_visit_steps,
             "location_frequency": self.location_frequency,
             "location_steps_spent": self.location_steps_spent,
-            "wild_encounters": self.wild_encounters,
+            "wild_encounters": self.encounter_log.to_encounters(),
+            "wild_encounter_log": self.encounter_log.array.copy(),
         }
         return info
@@ -0,0 +1,165 @@
+import argparse
+import json
+import multiprocessing as mp
+import queue
+import threading
+import time
+from pathlib import Path
+
+# Per-step history with a bounded memory footprint, used for RedGymEnv.agent_stats.
+#   "memory": keeps every row in memory (default, unbounded)
+#   "spill":  keeps at most chunk_size rows in memory, full chunks are appended to a JSON
+#             lines file by a writer thread
+#   "drop":   keeps at most chunk_size rows in memory and discards older ones, for runs
+#             that only need aggregates and the latest rows
+HISTORY_POLICIES = ("memory", "spill", "drop")
+
+
+def json_default(value):
+    # numpy scalars
+    return value.item() if hasattr(value, "item") else str(value)
+
+
+class StepHistory:
+    def __init__(self, policy="memory", chunk_size=1024, path=None):
+        if policy not in HISTORY_POLICIES:
+            raise ValueError(f"Unknown history policy: {policy}")
+        if policy == "spill" and path is None:
+            raise ValueError("The spill policy needs a path")
+        self.policy = policy
+        self.chunk_size = chunk_size
+        self.path = Path(path) if path is not None else None
+        self.chunk = []
+        self.flushed = 0
+        self.chunks = None
+        if policy == "spill":
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.file = open(self.path, "w")
+            self.written = 0
+            self.written_changed = threading.Condition()
+            self.chunks = queue.Queue()
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                return
+            self.file.write("".join(json.dumps(row, default=json_default) + "\n" for row in chunk))
+            self.file.flush()
+            with self.written_changed:
+                self.written += len(chunk)
+                self.written_changed.notify_all()
+
+    def append(self, row):
+        # flushes before appending so the latest row is always in memory
+        if self.policy != "memory" and len(self.chunk) >= self.chunk_size:
+            if self.chunks is not None:
+                self.chunks.put(self.chunk)
+            self.flushed += len(self.chunk)
+            self.chunk = []
+        self.chunk.append(row)
+
+    def __len__(self):
+        return self.flushed + len(self.chunk)
+
+    def __getitem__(self, index):
+        # only rows that are still in memory can be indexed
+        if index < 0:
+            index += len(self)
+        local = index - self.flushed
+        if not 0 <= local < len(self.chunk):
+            raise IndexError(f"Step {index} is not in memory (policy {self.policy})")
+        return self.chunk[local]
+
+    def __iter__(self):
+        # spilled rows are read back from disk, dropped rows are skipped
+        if self.policy == "spill" and self.flushed:
+            with self.written_changed:
+                self.written_changed.wait_for(lambda: self.written >= self.flushed)
+            with open(self.path) as f:
+                for _, line in zip(range(self.flushed), f):
+                    yield json.loads(line)
+        yield from self.chunk
+
+    def close(self):
+        # the spill policy writes the rows still in memory as well
+        if self.chunks is None:
+            return
+        if self.chunk:
+            self.chunks.put(self.chunk)
+        self.chunks.put(None)
+        self.thread.join()
+        self.file.close()
+        self.chunks = None
+
+
+def read_rss_kb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    return 0
+
+
+def run_benchmark(job):
+    # replays in a fresh process so the RSS numbers of the policies do not mix
+    replay_path, rom, state, policy, chunk_size, max_steps = job
+    from red_gym_env_v2 import RedGymEnv
+    from replay_common import load_actions, make_config
+
+    config = make_config(rom, state, headless=True)
+    config["agent_stats_policy"] = policy
+    config["agent_stats_chunk_size"] = chunk_size
+    actions = load_actions(replay_path)[:max_steps]
+    env = RedGymEnv(config=config)
+    env.reset()
+    start_rss = read_rss_kb()
+    peak_rss = start_rss
+    start = time.perf_counter()
+    for step, action in enumerate(actions):
+        env.step(action)
+        if step % 256 == 0:
+            peak_rss = max(peak_rss, read_rss_kb())
+    seconds = time.perf_counter() - start
+    peak_rss = max(peak_rss, read_rss_kb())
+    result = {
+        "policy": policy,
+        "steps": len(actions),
+        "seconds": seconds,
+        "start_rss": start_rss,
+        "peak_rss": peak_rss,
+        "agent_stats_in_memory": len(env.agent_stats.chunk),
+        "seen_coords": len(env.seen_coords),
+    }
+    env.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare RSS of the agent_stats history policies over the longest replay')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--chunk-size', type=int, help='Rows kept in memory by the bounded policies', default=1024)
+    parser.add_argument('--max-steps', type=int, help='Only replay this many steps', default=None)
+    args = parser.parse_args()
+
+    from replay_common import load_actions
+    replay_path = max(Path(args.replays).glob("*.json"), key=lambda p: len(load_actions(p)))
+    print(f"Replaying {replay_path}")
+    ctx = mp.get_context("spawn")
+    for policy in HISTORY_POLICIES:
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_benchmark, ((str(replay_path), args.rom, args.state, policy, args.chunk_size, args.max_steps),))
+        growth = (result["peak_rss"] - result["start_rss"]) / 1024
+        print(
+            f"{policy:>6}: {result['steps']} steps in {result['seconds']:.1f}s, peak rss {result['peak_rss'] / 1024:.0f}MB"
+            f" (+{growth:.1f}MB), agent_stats rows in memory {result['agent_stats_in_memory']},"
+            f" seen_coords {result['seen_coords']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
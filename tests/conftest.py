@@ -0,0 +1,36 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# the modules live in the repository root, which also holds pokered.sym
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+# The ROM is not part of the repository. Tests that emulate are skipped without it, point
+# POKEMON_RED_ROM at it if it is not ./PokemonRed.gb. Limit the replayed steps with REPLAY_STEPS.
+ROM = Path(os.environ.get("POKEMON_RED_ROM", ROOT / "PokemonRed.gb"))
+STATE = Path(os.environ.get("POKEMON_RED_STATE", ROOT / "has_pokedex_nballs_squirtle.state"))
+REPLAY = Path(os.environ.get("REPLAY_FILE", ROOT / "example_replay.json"))
+REPLAY_STEPS = int(os.environ.get("REPLAY_STEPS", 2000))
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+
+
+@pytest.fixture
+def config():
+    for path in (ROM, STATE, REPLAY):
+        if not path.exists():
+            pytest.skip(f"{path} not found")
+    from replay_common import make_config
+    return make_config(str(ROM), str(STATE), headless=True)
+
+
+@pytest.fixture
+def actions(config):
+    from replay_common import load_actions
+    return load_actions(REPLAY)[:REPLAY_STEPS]
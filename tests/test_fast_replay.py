@@ -0,0 +1,23 @@
+import numpy as np
+import pytest
+
+from red_gym_env_v2 import RedGymEnv
+from replay import replay_actions
+from replay_common import compare_infos
+from replay_env import ReplayEnv
+from stats_wrapper import StatsWrapper
+
+
+@pytest.mark.parametrize("env_cls", [RedGymEnv, ReplayEnv])
+def test_fast_replay_matches_step_by_step(config, actions, env_cls):
+    results = []
+    for fast in (False, True):
+        env = StatsWrapper(env_cls(config=config))
+        env.reset()
+        steps, rewards = replay_actions(env, actions, fast=fast)
+        results.append((steps, rewards, env.get_info()))
+        env.close()
+    (steps, rewards, info), (fast_steps, fast_rewards, fast_info) = results
+    assert fast_steps == steps == len(actions)
+    assert np.isclose(fast_rewards, rewards)
+    assert compare_infos(info, fast_info) == []
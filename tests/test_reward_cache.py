@@ -0,0 +1,17 @@
+from red_gym_env_v2 import RedGymEnv
+from reward_check import UncachedRewardEnv
+
+
+def test_incremental_reward_matches_full_recomputation(config, actions):
+    cached = RedGymEnv(config=config)
+    reference = UncachedRewardEnv(config=config)
+    cached.reset()
+    reference.reset()
+    assert cached.progress_reward == reference.progress_reward
+    for step, action in enumerate(actions):
+        _, reward, _, _, _ = cached.step(action)
+        _, reference_reward, _, _, _ = reference.step(action)
+        assert reward == reference_reward, f"step {step}"
+        assert cached.progress_reward == reference.progress_reward, f"step {step}"
+    cached.close()
+    reference.close()
@@ -0,0 +1,140 @@
+import argparse
+import hashlib
+import uuid
+from multiprocessing import Pool
+from pathlib import Path
+
+import numpy as np
+
+from event_hooks import NUM_EVENT_BITS
+from global_map import local_to_global_batch
+from red_gym_env_v2 import load_init_states
+from replay_common import load_actions, make_config
+from replay_env import ReplayEnv
+
+# Compact per-replay trajectory index, stored next to the replay as <replay>.traj.npz.
+# Per-step columns have one row per step, index 0 is the state after reset.
+# Bump TRAJECTORY_VERSION whenever the extraction changes, older indexes are rebuilt. Indexes
+# also store a hash of the start states they were extracted from.
+TRAJECTORY_VERSION = 1
+
+TRAJECTORY_COLUMNS = {
+    "map": np.uint8,
+    "x": np.uint8,
+    "y": np.uint8,
+    "global_y": np.uint16,
+    "global_x": np.uint16,
+    "party_count": np.uint8,
+    "party_levels": np.uint8,  # (steps, 6)
+    "hp_fraction": np.float32,
+    "badges": np.uint8,
+    "in_battle": np.int8,  # -1 lost battle, 0 no battle, 1 wild battle, 2 trainer battle
+    "events_count": np.uint16,
+}
+
+def extract_trajectory(replay_path, rom, state):
+    env = ReplayEnv(config=make_config(rom, state, headless=True))
+    env.reset()
+    _, in_battle_address = env.pyboy.symbol_lookup("wIsInBattle")
+    actions = load_actions(replay_path)
+    num_steps = len(actions) + 1
+    columns = {
+        key: np.zeros((num_steps, 6) if key == "party_levels" else num_steps, dtype=dtype)
+        for key, dtype in TRAJECTORY_COLUMNS.items()
+    }
+    # flags already set at the start have step 0, flags never set -1
+    event_first_step = np.full(NUM_EVENT_BITS, -1, dtype=np.int32)
+    event_bytes = None
+    event_bits = None
+
+    for step in range(num_steps):
+        if step > 0:
+            env.step(actions[step - 1])
+        columns["x"][step], columns["y"][step], columns["map"][step] = env.get_game_coords()
+        columns["party_count"][step] = env.read_m(0xD163)
+        columns["party_levels"][step] = env.read_party_levels()
+        columns["hp_fraction"][step] = env.read_hp_fraction()
+        columns["badges"][step] = env.get_badges()
+        columns["in_battle"][step] = np.uint8(env.read_m(in_battle_address)).view(np.int8)
+        new_event_bytes = env.read_event_bytes()
+        if event_bytes is None or not np.array_equal(new_event_bytes, event_bytes):
+            event_bytes = new_event_bytes
+            event_bits = np.unpackbits(event_bytes, bitorder="little")
+            event_first_step[(event_bits == 1) & (event_first_step == -1)] = step
+        columns["events_count"][step] = event_bits.sum()
+    env.close()
+
+    columns["global_y"][:], columns["global_x"][:] = local_to_global_batch(
+        columns["y"], columns["x"], columns["map"]
+    )
+    columns["event_first_step"] = event_first_step
+    return columns
+
+
+def trajectory_path(replay_path):
+    replay_path = Path(str(replay_path).replace(".pkl", ".json"))
+    return replay_path.with_name(replay_path.stem + ".traj.npz")
+
+
+def init_state_hash(state):
+    digest = hashlib.blake2b(digest_size=16)
+    for init_state in load_init_states(state):
+        digest.update(init_state)
+    return digest.hexdigest()
+
+
+def read_trajectory(path, state_hash=None):
+    # returns None if the index is missing, was written by another extraction version or,
+    # when state_hash is given, extracted from other start states
+    path = Path(path)
+    if not path.exists():
+        return None
+    with np.load(path) as data:
+        if "version" not in data or int(data["version"]) != TRAJECTORY_VERSION:
+            return None
+        if state_hash is not None and ("init_state_hash" not in data or str(data["init_state_hash"]) != state_hash):
+            return None
+        return {key: data[key] for key in data.files if key not in ("version", "init_state_hash")}
+
+
+def load_trajectory(replay_path, rom, state):
+    # re-emulates only if there is no up to date index next to the replay
+    path = trajectory_path(replay_path)
+    state_hash = init_state_hash(state)
+    if path.exists() and path.stat().st_mtime >= Path(replay_path).stat().st_mtime:
+        trajectory = read_trajectory(path, state_hash)
+        if trajectory is not None:
+            return trajectory
+    trajectory = extract_trajectory(replay_path, rom, state)
+    # unique temp name, several tools may build the same index at once
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp.npz")
+    np.savez_compressed(
+        tmp_path, version=np.int32(TRAJECTORY_VERSION), init_state_hash=np.str_(state_hash), **trajectory
+    )
+    tmp_path.replace(path)
+    return trajectory
+
+
+def build_index(job):
+    replay_path, rom, state = job
+    trajectory = load_trajectory(replay_path, rom, state)
+    return replay_path, len(trajectory["map"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the trajectory index next to every replay')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--workers', type=int, help='Number of parallel workers', default=None)
+    args = parser.parse_args()
+
+    replay_paths = sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem))
+    jobs = [(str(p), args.rom, args.state) for p in replay_paths]
+    with Pool(args.workers) as pool:
+        for replay_path, num_steps in pool.imap_unordered(build_index, jobs):
+            print(f"{trajectory_path(replay_path)}: {num_steps} steps")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,379 @@
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+from collections import Counter
+from multiprocessing import Process
+from pathlib import Path
+
+from replay_common import load_actions, make_config
+
+# Work queue on a shared filesystem, no broker needed. Layout of the queue directory:
+#   jobs/<id>.json     job specs, written once by enqueue
+#   leases/<id>.json   owner of a running job. Created with O_EXCL, so only one worker wins.
+#                      The owner touches it every heartbeat, a lease older than lease_seconds
+#                      belongs to a dead worker and is reclaimed by renaming it away, which
+#                      again only one worker can do.
+#   results/<id>.json  linked into place from a temp file, the first result of a job wins
+#                      and repeated runs of a job are harmless.
+#   states/<replay>_<step>.state
+#                      savestate at the end of a segment. The job of the next segment of the
+#                      replay starts from it and can only be claimed once it exists, so every
+#                      step of a replay is emulated once.
+#   failures/<id>/<uuid>.json
+#                      one file per attempt that raised. Jobs with max_attempts failures are
+#                      no longer handed out, so a bad replay or state file cannot cycle
+#                      through the workers forever.
+# Worker clocks should agree with the file server to well below lease_seconds.
+
+
+def write_json_atomic(path, data):
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    return tmp_path
+
+
+class WorkQueue:
+    def __init__(self, directory, lease_seconds=60.0, max_attempts=3):
+        self.directory = Path(directory)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.jobs_dir = self.directory / "jobs"
+        self.leases_dir = self.directory / "leases"
+        self.results_dir = self.directory / "results"
+        self.states_dir = self.directory / "states"
+        self.failures_dir = self.directory / "failures"
+        for d in (self.jobs_dir, self.leases_dir, self.results_dir, self.states_dir, self.failures_dir):
+            d.mkdir(parents=True, exist_ok=True)
+
+    def enqueue(self, job_id, spec):
+        path = self.jobs_dir / f"{job_id}.json"
+        if path.exists():
+            return False
+        tmp_path = write_json_atomic(path, spec)
+        tmp_path.replace(path)
+        return True
+
+    def job_ids(self):
+        return sorted(p.stem for p in self.jobs_dir.glob("*.json"))
+
+    def read_spec(self, job_id):
+        with open(self.jobs_dir / f"{job_id}.json") as f:
+            return json.load(f)
+
+    def is_ready(self, spec):
+        # segments after the first wait for the savestate of their start step
+        return spec.get("start_state") is None or Path(spec["start_state"]).exists()
+
+    def state_path(self, replay_path, step):
+        return self.states_dir / f"{Path(replay_path).stem}_{step}.state"
+
+    def is_done(self, job_id):
+        return (self.results_dir / f"{job_id}.json").exists()
+
+    def attempts_failed(self, job_id):
+        return len(list((self.failures_dir / job_id).glob("*.json")))
+
+    def is_failed(self, job_id):
+        return self.attempts_failed(job_id) >= self.max_attempts
+
+    def lease_path(self, job_id):
+        return self.leases_dir / f"{job_id}.json"
+
+    def lease_expired(self, job_id):
+        try:
+            return time.time() - self.lease_path(job_id).stat().st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+    def try_lease(self, job_id, worker_id):
+        try:
+            fd = os.open(self.lease_path(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, "w") as f:
+            json.dump({"worker": worker_id, "host": socket.gethostname(), "pid": os.getpid()}, f)
+        return True
+
+    def reclaim(self, job_id):
+        # moves an expired lease away, only one of several competing workers succeeds
+        stale_path = self.leases_dir / f".{job_id}.{uuid.uuid4().hex}.stale"
+        try:
+            os.rename(self.lease_path(job_id), stale_path)
+        except FileNotFoundError:
+            return False
+        # the lease may have been renewed between the expiry check and the rename
+        if time.time() - stale_path.stat().st_mtime <= self.lease_seconds:
+            try:
+                os.link(stale_path, self.lease_path(job_id))
+            except FileExistsError:
+                pass
+            stale_path.unlink()
+            return False
+        stale_path.unlink()
+        return True
+
+    def claim(self, worker_id):
+        # returns (job id, spec) of a job that is neither done nor leased, None if there is none
+        for job_id in self.job_ids():
+            if self.is_done(job_id) or self.is_failed(job_id):
+                continue
+            spec = self.read_spec(job_id)
+            if not self.is_ready(spec):
+                continue
+            if self.lease_path(job_id).exists():
+                if not (self.lease_expired(job_id) and self.reclaim(job_id)):
+                    continue
+            if not self.try_lease(job_id, worker_id):
+                continue
+            if self.is_done(job_id):
+                self.release(job_id)
+                continue
+            return job_id, spec
+        return None
+
+    def heartbeat(self, job_id):
+        try:
+            os.utime(self.lease_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def owns_lease(self, job_id, worker_id):
+        try:
+            with open(self.lease_path(job_id)) as f:
+                return json.load(f)["worker"] == worker_id
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False
+
+    def complete(self, job_id, result):
+        # idempotent, keeps the first result written for the job
+        path = self.results_dir / f"{job_id}.json"
+        tmp_path = write_json_atomic(path, result)
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        finally:
+            tmp_path.unlink()
+        self.release(job_id)
+
+    def fail(self, job_id, worker_id, error):
+        # records a failed attempt and hands the job back, unless it failed max_attempts times
+        path = self.failures_dir / job_id / f"{uuid.uuid4().hex}.json"
+        path.parent.mkdir(exist_ok=True)
+        tmp_path = write_json_atomic(path, {"worker": worker_id, "time": time.time(), "error": error})
+        tmp_path.replace(path)
+        self.release(job_id)
+
+    def release(self, job_id):
+        try:
+            self.lease_path(job_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def results(self):
+        results = {}
+        for path in sorted(self.results_dir.glob("*.json")):
+            with open(path) as f:
+                results[path.stem] = json.load(f)
+        return results
+
+    def failures(self):
+        # job id -> failed attempts, oldest first
+        failures = {}
+        for path in self.failures_dir.glob("*/*.json"):
+            with open(path) as f:
+                failures.setdefault(path.parent.name, []).append(json.load(f))
+        return {job_id: sorted(attempts, key=lambda a: a["time"]) for job_id, attempts in sorted(failures.items())}
+
+    def status(self):
+        counts = Counter()
+        for job_id in self.job_ids():
+            if self.is_done(job_id):
+                counts["done"] += 1
+            elif self.is_failed(job_id):
+                counts["failed"] += 1
+            elif self.lease_path(job_id).exists():
+                counts["expired" if self.lease_expired(job_id) else "running"] += 1
+            elif not self.is_ready(self.read_spec(job_id)):
+                counts["waiting"] += 1
+            else:
+                counts["pending"] += 1
+        return counts
+
+
+class Heartbeat:
+    # touches the lease of the current job every interval seconds from a background thread
+    def __init__(self, queue, job_id, interval):
+        self.queue = queue
+        self.job_id = job_id
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.queue.heartbeat(self.job_id)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+def restore_segment_start(env, spec):
+    # puts the StatsWrapper env at the start step of the segment. Stats count from there,
+    # so events_sum and seen_coords of a segment only cover its own steps.
+    env.reset()
+    if spec.get("start_state") is None:
+        return
+    with open(spec["start_state"], "rb") as f:
+        env.restore_state(f, spec["start"])
+
+
+def save_state_atomic(env, path):
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+    env.save_state(tmp_path)
+    tmp_path.replace(path)
+
+
+def replay_segment_stats(env, spec):
+    # replays steps start..end from the segment's start state and summarizes them
+    from map_data import map_locations
+
+    actions = load_actions(spec["replay"])
+    start = spec.get("start", 0)
+    end = min(spec.get("end", len(actions)), len(actions))
+    restore_segment_start(env, spec)
+    steps_per_map = Counter()
+    for action in actions[start:end]:
+        env.step(action)
+        steps_per_map[map_locations.get(int(env.current_location), str(env.current_location))] += 1
+    if spec.get("end_state") is not None:
+        save_state_atomic(env.env, Path(spec["end_state"]))
+    events = sorted(name for name, event_step in env.events_steps.items() if start < event_step <= end)
+    return {
+        "replay": spec["replay"],
+        "start": start,
+        "end": end,
+        "steps_per_map": dict(steps_per_map),
+        "events": events,
+        "events_sum": int(env.events_sum),
+        "seen_coords": int(env.seen_coords),
+        "party_levels": [int(level) for level in env.party_levels],
+    }
+
+
+def run_worker(queue_dir, rom, state, lease_seconds=60.0, crash_after=None, max_attempts=3):
+    # processes jobs until none are left to claim. crash_after simulates a dead node, the worker
+    # exits without a result after claiming that many jobs.
+    from red_gym_env_v2 import RedGymEnv
+    from stats_wrapper import StatsWrapper
+
+    queue = WorkQueue(queue_dir, lease_seconds, max_attempts)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    env = StatsWrapper(RedGymEnv(config=make_config(rom, state, headless=True)))
+    claimed = 0
+    while True:
+        job = queue.claim(worker_id)
+        if job is None:
+            status = queue.status()
+            if status["running"] == 0 and status["expired"] == 0:
+                break
+            # wait for running jobs, they may unlock the next segment or their worker may die
+            time.sleep(min(lease_seconds / 4, 5.0))
+            continue
+        job_id, spec = job
+        claimed += 1
+        if crash_after is not None and claimed > crash_after:
+            os._exit(1)
+        print(f"{worker_id}: {job_id}", flush=True)
+        try:
+            with Heartbeat(queue, job_id, lease_seconds / 4):
+                result = replay_segment_stats(env, spec)
+        except Exception:
+            error = traceback.format_exc()
+            print(f"{worker_id}: {job_id} failed\n{error}", flush=True)
+            queue.fail(job_id, worker_id, error)
+            continue
+        if not queue.owns_lease(job_id, worker_id):
+            print(f"{worker_id}: lost the lease of {job_id}, result kept only if it is the first", flush=True)
+        queue.complete(job_id, result)
+    env.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='File based work queue for replay processing on a shared filesystem')
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="Add one job per replay or replay segment")
+    enqueue_parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    enqueue_parser.add_argument('--segment', type=int, help='Split replays into segments of this many steps', default=None)
+
+    work_parser = subparsers.add_parser("work", help="Process jobs until the queue is drained")
+    work_parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    work_parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    work_parser.add_argument('--processes', type=int, help='Worker processes on this node, each acts like a separate node', default=1)
+    work_parser.add_argument('--crash-after', type=int, help='The first process dies after claiming this many jobs, to test lease reclaiming', default=None)
+
+    work_parser.add_argument('--max-attempts', type=int, help='Jobs that raised this many times are not handed out again', default=3)
+
+    subparsers.add_parser("status", help="Count pending, waiting, running, expired, failed and done jobs")
+    subparsers.add_parser("results", help="Print the collected results")
+    subparsers.add_parser("failures", help="Print the errors of failed attempts")
+
+    for sub in subparsers.choices.values():
+        sub.add_argument('--queue', type=str, help='Queue directory on the shared filesystem', default="./session/queue")
+        sub.add_argument('--lease-seconds', type=float, help='Leases without heartbeat for this long are reclaimed', default=60.0)
+    args = parser.parse_args()
+
+    queue = WorkQueue(args.queue, args.lease_seconds)
+    if args.command == "enqueue":
+        added = 0
+        for replay_path in sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem)):
+            num_steps = len(load_actions(replay_path))
+            segment = args.segment or num_steps
+            for start in range(0, num_steps, segment):
+                end = min(start + segment, num_steps)
+                job_id = f"{replay_path.stem}_{start}_{end}"
+                added += queue.enqueue(job_id, {
+                    "replay": str(replay_path),
+                    "start": start,
+                    "end": end,
+                    "start_state": str(queue.state_path(replay_path, start)) if start > 0 else None,
+                    "end_state": str(queue.state_path(replay_path, end)) if end < num_steps else None,
+                })
+        print(f"Added {added} jobs")
+    elif args.command == "work":
+        processes = [
+            Process(target=run_worker, args=(
+                args.queue, args.rom, args.state, args.lease_seconds, args.crash_after if i == 0 else None,
+                args.max_attempts,
+            ))
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+    elif args.command == "status":
+        status = queue.status()
+        print(", ".join(f"{key}: {status[key]}" for key in ("pending", "waiting", "running", "expired", "failed", "done")))
+    elif args.command == "results":
+        print(json.dumps(queue.results(), indent=2))
+    elif args.command == "failures":
+        print(json.dumps(queue.failures(), indent=2))
+
+
+if __name__ == "__main__":
+    main()
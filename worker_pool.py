@@ -0,0 +1,268 @@
+import argparse
+import io
+import multiprocessing as mp
+import os
+import queue
+import random
+import threading
+import time
+import traceback
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+
+from red_gym_env_v2 import RedGymEnv
+from replay_common import load_actions, make_config
+from stats_wrapper import StatsWrapper
+
+# Long lived pool of warm env processes for many short interactive jobs. Workers keep their
+# emulator between jobs, every job starts from env.reset() (restore start state, reset the
+# wrappers) and workers are replaced after max_jobs jobs to bound memory growth. Workers that
+# die without reporting back (segfault, OOM kill) fail their current job and are replaced too.
+
+
+# values of a worker's current job id before it runs any job
+WORKER_STARTING = -2
+WORKER_IDLE = -1
+
+
+class WarmWorker:
+    # what job functions get as first argument
+    def __init__(self, config, lightweight, checkpoint_interval):
+        if lightweight:
+            from replay_env import ReplayEnv
+            self.env = StatsWrapper(ReplayEnv(config))
+        else:
+            self.env = StatsWrapper(RedGymEnv(config))
+        self.env.reset()
+        self.checkpoint_interval = checkpoint_interval
+        # replay path -> {step: savestate bytes}, lives as long as the worker
+        self.checkpoints = {}
+        self.actions = {}
+
+    def load_actions(self, replay_path):
+        if replay_path not in self.actions:
+            self.actions[replay_path] = load_actions(replay_path)
+        return self.actions[replay_path]
+
+    def seek(self, replay_path, step):
+        # puts the env at step of the replay starting from the nearest cached checkpoint.
+        # Accumulated stats of the env and wrapper count from the checkpoint.
+        self.env.reset()
+        actions = self.load_actions(replay_path)
+        checkpoints = self.checkpoints.setdefault(replay_path, {})
+        current = max((s for s in checkpoints if s <= step), default=0)
+        if current > 0:
+            self.env.restore_state(io.BytesIO(checkpoints[current]), current)
+        while current < step:
+            self.env.step(actions[current])
+            current += 1
+            if current % self.checkpoint_interval == 0 and current not in checkpoints:
+                state = io.BytesIO()
+                self.env.env.pyboy.save_state(state)
+                checkpoints[current] = state.getvalue()
+        return actions
+
+
+def replay_segment(worker, replay_path, start, end):
+    # positions and event counts of steps start..end of a replay
+    actions = worker.seek(replay_path, start)
+    end = min(end, len(actions))
+    env = worker.env.env
+    positions = np.zeros((end - start, 3), dtype=np.uint8)
+    events_count = np.zeros(end - start, dtype=np.uint16)
+    for i, step in enumerate(range(start, end)):
+        worker.env.step(actions[step])
+        positions[i] = env.get_game_coords()
+        events_count[i] = np.unpackbits(env.read_event_bytes()).sum()
+    return {"x": positions[:, 0], "y": positions[:, 1], "map": positions[:, 2], "events_count": events_count}
+
+
+def worker_main(config, lightweight, checkpoint_interval, max_jobs, jobs, results, current_job):
+    start = time.monotonic()
+    worker = WarmWorker(config, lightweight, checkpoint_interval)
+    # messages can be lost if the process dies right after a put, the shared value cannot
+    current_job.value = WORKER_IDLE
+    results.put(("ready", os.getpid(), time.monotonic() - start))
+    for _ in range(max_jobs):
+        job = jobs.get()
+        if job is None:
+            break
+        job_id, fn, args, submitted = job
+        current_job.value = job_id
+        started = time.monotonic()
+        try:
+            status, result = "ok", fn(worker, *args)
+        except Exception:
+            status, result = "error", traceback.format_exc()
+        finished = time.monotonic()
+        timing = {"queued": started - submitted, "run": finished - started, "worker": os.getpid()}
+        results.put((job_id, status, result, timing))
+    worker.env.close()
+    results.put(("exit", os.getpid(), None))
+
+
+class WarmPool:
+    def __init__(self, config, workers=4, max_jobs=100, lightweight=False, checkpoint_interval=1000, poll_seconds=1.0):
+        self.ctx = mp.get_context("spawn")
+        self.worker_args = (config, lightweight, checkpoint_interval, max_jobs)
+        self.jobs = self.ctx.Queue()
+        self.results = self.ctx.Queue()
+        self.futures = {}
+        self.timings = []
+        self.startup_seconds = []
+        self.recycled = 0
+        self.crashed = 0
+        self.poll_seconds = poll_seconds
+        self.next_job_id = 0
+        self.lock = threading.Lock()
+        self.closed = False
+        self.processes = {}
+        self.current_jobs = {}
+        for _ in range(workers):
+            self.start_worker()
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def start_worker(self):
+        current_job = self.ctx.Value("q", WORKER_STARTING, lock=False)
+        process = self.ctx.Process(
+            target=worker_main, args=(*self.worker_args, self.jobs, self.results, current_job), daemon=True
+        )
+        process.start()
+        self.processes[process.pid] = process
+        self.current_jobs[process.pid] = current_job
+
+    def collect(self):
+        while True:
+            try:
+                message = self.results.get(timeout=self.poll_seconds)
+            except queue.Empty:
+                self.replace_crashed_workers()
+                continue
+            if message is None:
+                return
+            if message[0] == "ready":
+                self.startup_seconds.append(message[2])
+                continue
+            if message[0] == "exit":
+                self.processes.pop(message[1]).join()
+                self.current_jobs.pop(message[1])
+                if not self.closed:
+                    self.recycled += 1
+                    self.start_worker()
+                continue
+            job_id, status, result, timing = message
+            with self.lock:
+                # None if the job was failed because its worker was considered dead
+                future = self.futures.pop(job_id, None)
+                self.timings.append(timing)
+            if future is None:
+                continue
+            if status == "ok":
+                future.set_result(result)
+            else:
+                future.set_exception(RuntimeError(result))
+
+    def replace_crashed_workers(self):
+        # workers that exit normally report it, a nonzero exit code without report is a crash
+        for pid, process in list(self.processes.items()):
+            if process.is_alive() or process.exitcode == 0:
+                continue
+            process.join()
+            del self.processes[pid]
+            job_id = self.current_jobs.pop(pid).value
+            with self.lock:
+                future = self.futures.pop(job_id, None)
+            if future is not None:
+                future.set_exception(RuntimeError(
+                    f"Worker {pid} died with exit code {process.exitcode} while running job {job_id}"
+                ))
+            self.crashed += 1
+            # a worker that died before it was ready would die again on restart
+            if job_id == WORKER_STARTING:
+                print(f"Worker {pid} died during startup with exit code {process.exitcode}, not replaced")
+            elif not self.closed:
+                self.start_worker()
+        if not self.processes:
+            with self.lock:
+                futures, self.futures = list(self.futures.values()), {}
+            for future in futures:
+                future.set_exception(RuntimeError("All workers of the pool died"))
+
+    def submit(self, fn, *args):
+        # fn(worker, *args) runs in a worker process, fn must be importable by the workers
+        future = Future()
+        if not self.processes:
+            raise RuntimeError("All workers of the pool died")
+        with self.lock:
+            job_id = self.next_job_id
+            self.next_job_id += 1
+            self.futures[job_id] = future
+        self.jobs.put((job_id, fn, args, time.monotonic()))
+        return future
+
+    def replay_segment(self, replay_path, start, end):
+        return self.submit(replay_segment, str(replay_path), start, end)
+
+    def metrics(self):
+        with self.lock:
+            timings = list(self.timings)
+        result = {"jobs": len(timings), "recycled_workers": self.recycled, "crashed_workers": self.crashed}
+        if self.startup_seconds:
+            result["worker_startup_mean"] = float(np.mean(self.startup_seconds))
+        if timings:
+            queued = np.array([t["queued"] for t in timings])
+            run = np.array([t["run"] for t in timings])
+            for name, values in (("queued", queued), ("run", run), ("latency", queued + run)):
+                result[f"{name}_p50"] = float(np.percentile(values, 50))
+                result[f"{name}_p95"] = float(np.percentile(values, 95))
+        return result
+
+    def close(self):
+        self.closed = True
+        for _ in range(len(self.processes)):
+            self.jobs.put(None)
+        for process in list(self.processes.values()):
+            process.join()
+        self.results.put(None)
+        self.collector.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run random replay segment jobs on a pool of warm workers')
+    parser.add_argument('--rom', type=str, help='Path to the Game Boy ROM file', default="./PokemonRed.gb")
+    parser.add_argument('--state', type=str, help='Path to the initial state file', default="./has_pokedex_nballs_squirtle.state")
+    parser.add_argument('--replays', type=str, help='Directory containing the replay files', default="./replays")
+    parser.add_argument('--workers', type=int, help='Number of worker processes', default=4)
+    parser.add_argument('--max-jobs', type=int, help='Jobs per worker before it is replaced', default=100)
+    parser.add_argument('--jobs', type=int, help='Number of jobs to run', default=40)
+    parser.add_argument('--length', type=int, help='Steps per segment', default=1000)
+    parser.add_argument('--lightweight', action='store_true', help="Use the minimal ReplayEnv.", default=False)
+    args = parser.parse_args()
+
+    replay_paths = sorted(Path(args.replays).glob("*.json"), key=lambda p: (len(p.stem), p.stem))
+    lengths = {p: len(load_actions(p)) for p in replay_paths}
+    rng = random.Random(0)
+    config = make_config(args.rom, args.state, headless=True)
+    with WarmPool(config, args.workers, args.max_jobs, args.lightweight) as pool:
+        futures = []
+        for _ in range(args.jobs):
+            replay_path = rng.choice(replay_paths)
+            start = rng.randrange(0, max(lengths[replay_path] - args.length, 1))
+            futures.append(pool.replay_segment(replay_path, start, start + args.length))
+        for future in futures:
+            future.result()
+        for key, value in pool.metrics().items():
+            print(f"{key}: {value:.3f}" if isinstance(value, float) else f"{key}: {value}")
+
+
+if __name__ == "__main__":
+    main()